@@ -0,0 +1,31 @@
+'''JSON-кодек обработчиков: orjson, если установлен, иначе стандартный json'''
+import json
+from datetime import date, datetime
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+try:
+    import orjson
+    
+    BACKEND = 'orjson'
+    
+    def dumps(data) -> str:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(text):
+        return orjson.loads(text)
+
+except ImportError:
+    BACKEND = 'json'
+    
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+    _decoder = json.JSONDecoder()
+    
+    def dumps(data) -> str:
+        return _encoder.encode(data)
+    
+    def loads(text):
+        return _decoder.decode(text)
@@ -0,0 +1,88 @@
+'''Сборка HTTP-ответов в формате облачных функций'''
+import math
+import time
+
+from core import instrumentation
+from core.codec import dumps
+
+ALLOW_HEADERS = 'Content-Type, X-Authorization, If-None-Match'
+
+JSON_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*'
+}
+
+def encode_body(data) -> str:
+    if not instrumentation.ENABLED:
+        return dumps(data)
+    started = time.perf_counter()
+    body = dumps(data)
+    instrumentation.record_serialize(started)
+    return body
+
+def preflight_headers(methods: str, allow_headers: str = ALLOW_HEADERS) -> dict:
+    return {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': methods,
+        'Access-Control-Allow-Headers': allow_headers,
+        'Access-Control-Max-Age': '86400'
+    }
+
+def preflight_response(headers: dict) -> dict:
+    return {
+        'statusCode': 200,
+        'headers': {**headers},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def etag_headers(etag: str) -> dict:
+    return {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'Access-Control-Expose-Headers': 'ETag'
+    }
+
+def success_response(data: dict, headers: dict = None) -> dict:
+    return {
+        'statusCode': 200,
+        'headers': {**JSON_HEADERS, **headers} if headers else {**JSON_HEADERS},
+        'body': encode_body(data),
+        'isBase64Encoded': False
+    }
+
+def error_response(message: str, status_code: int) -> dict:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS},
+        'body': encode_body({'error': message}),
+        'isBase64Encoded': False
+    }
+
+def too_many_requests_response(retry_after: float) -> dict:
+    return {
+        'statusCode': 429,
+        'headers': {**JSON_HEADERS, 'Retry-After': str(max(math.ceil(retry_after), 1))},
+        'body': encode_body({'error': 'Too many requests'}),
+        'isBase64Encoded': False
+    }
+
+def no_content_response() -> dict:
+    return {
+        'statusCode': 204,
+        'headers': {**CORS_HEADERS},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def not_modified_response(etag: str) -> dict:
+    return {
+        'statusCode': 304,
+        'headers': {**CORS_HEADERS, **etag_headers(etag)},
+        'body': '',
+        'isBase64Encoded': False
+    }
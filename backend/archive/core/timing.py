@@ -0,0 +1,10 @@
+'''Замеры времени и структурные строки лога'''
+import time
+
+from core.codec import dumps
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 2)
+
+def log_event(name: str, payload: dict):
+    print(dumps({name: payload}))
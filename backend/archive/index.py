@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+
+# core лежит рядом с index.py: функция разворачивается одним каталогом (см. vendor_core.py)
+FUNCTION_DIR = os.path.dirname(os.path.abspath(__file__))
+if FUNCTION_DIR not in sys.path:
+    sys.path.insert(0, FUNCTION_DIR)
+
+from core.archive import CODEC, encode_segment, manifest_key, segment_key
+from core.codec import dumps
+from core.db import db_connection
+from core.instrumentation import instrumented
+from core.request import get_token, parse_body
+from core.responses import error_response, preflight_headers, preflight_response, success_response
+from core.storage import BUCKET, IMMUTABLE_CACHE_CONTROL, get_s3_client
+from core.timing import elapsed_ms, log_event
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_SEGMENT_SIZE = int(os.environ.get('CHAT_ARCHIVE_SEGMENT_SIZE', '5000'))
+ARCHIVE_TIME_BUDGET = float(os.environ.get('CHAT_ARCHIVE_TIME_BUDGET', '20'))
+ARCHIVE_LOCK = 0x6468_0003
+
+PREFLIGHT_HEADERS = preflight_headers('POST, OPTIONS')
+
+@instrumented('archive')
+def handler(event: dict, context) -> dict:
+    '''Перенос старой истории чата в сжатые сегменты S3 (запускается по расписанию)'''
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return preflight_response(PREFLIGHT_HEADERS)
+    
+    if method != 'POST':
+        return error_response('Method not allowed', 405)
+    
+    try:
+        body = parse_body(event)
+        
+        try:
+            after_days = max(int(body.get('olderThanDays', ARCHIVE_AFTER_DAYS)), 1)
+        except (TypeError, ValueError):
+            return error_response('Invalid olderThanDays', 400)
+        
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT is_admin FROM darkhaven_users WHERE token = %s', (get_token(event),))
+            user = cur.fetchone()
+        
+        if not user:
+            return error_response('Unauthorized', 401)
+        
+        if not user[0]:
+            return error_response('Forbidden', 403)
+        
+        return success_response(archive_messages(after_days))
+    
+    except Exception as e:
+        return error_response(str(e), 500)
+
+def archive_messages(after_days: int) -> dict:
+    started = time.perf_counter()
+    deadline = time.monotonic() + ARCHIVE_TIME_BUDGET
+    s3 = get_s3_client()
+    archived = {}
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT pg_try_advisory_lock(%s)', (ARCHIVE_LOCK,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return {'success': False, 'error': 'Archive job already running'}
+        
+        try:
+            cur.execute('SELECT CURRENT_TIMESTAMP - make_interval(days => %s)', (after_days,))
+            cutoff = cur.fetchone()[0]
+            cur.execute('SELECT id FROM darkhaven_chat_rooms ORDER BY id')
+            room_ids = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            
+            for room_id in room_ids:
+                while time.monotonic() < deadline:
+                    count = archive_segment(conn, s3, room_id, cutoff)
+                    if not count:
+                        break
+                    archived[room_id] = archived.get(room_id, 0) + count
+                
+                if room_id in archived:
+                    write_manifest(conn, s3, room_id)
+            
+            dropped = drop_archived_partitions(conn, cutoff) if time.monotonic() < deadline else []
+        finally:
+            conn.rollback()
+            cur.execute('SELECT pg_advisory_unlock(%s)', (ARCHIVE_LOCK,))
+            conn.commit()
+    
+    result = {
+        'success': True,
+        'cutoff': cutoff,
+        'archived': archived,
+        'droppedPartitions': dropped,
+        'complete': time.monotonic() < deadline,
+        'totalMs': elapsed_ms(started)
+    }
+    log_event('chatArchive', result)
+    return result
+
+def archive_segment(conn, s3, room_id: str, cutoff) -> int:
+    '''Сегмент сначала пишется в S3, затем в одной транзакции попадает в манифест и удаляется из БД'''
+    with conn.cursor() as cur:
+        cur.execute('''
+            SELECT id, user_id, message, created_at, edited
+            FROM darkhaven_messages
+            WHERE room_id = %s AND created_at < %s
+            ORDER BY id
+            LIMIT %s
+        ''', (room_id, cutoff, ARCHIVE_SEGMENT_SIZE))
+        rows = cur.fetchall()
+        conn.rollback()
+        
+        if not rows:
+            return 0
+        
+        messages = [{
+            'id': row[0],
+            'userId': row[1],
+            'message': row[2],
+            'timestamp': row[3],
+            'edited': row[4]
+        } for row in rows]
+        key = segment_key(room_id, rows[0][0], rows[-1][0])
+        
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=key,
+            Body=encode_segment(messages),
+            ContentType='application/x-ndjson',
+            CacheControl=IMMUTABLE_CACHE_CONTROL
+        )
+        
+        cur.execute('''
+            INSERT INTO darkhaven_message_segments
+                (room_id, first_id, last_id, first_at, last_at, message_count, object_key, codec)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (object_key) DO NOTHING
+        ''', (room_id, rows[0][0], rows[-1][0], min(row[3] for row in rows), max(row[3] for row in rows),
+              len(rows), key, CODEC))
+        cur.execute('''
+            DELETE FROM darkhaven_messages
+            WHERE room_id = %s AND id = ANY(%s) AND created_at < %s
+        ''', (room_id, [row[0] for row in rows], cutoff))
+        conn.commit()
+    
+    return len(rows)
+
+def write_manifest(conn, s3, room_id: str):
+    with conn.cursor() as cur:
+        cur.execute('''
+            SELECT object_key, codec, first_id, last_id, first_at, last_at, message_count
+            FROM darkhaven_message_segments
+            WHERE room_id = %s
+            ORDER BY last_id
+        ''', (room_id,))
+        segments = [{
+            'key': row[0],
+            'codec': row[1],
+            'firstId': row[2],
+            'lastId': row[3],
+            'firstAt': row[4],
+            'lastAt': row[5],
+            'count': row[6]
+        } for row in cur.fetchall()]
+        conn.rollback()
+    
+    s3.put_object(
+        Bucket=BUCKET,
+        Key=manifest_key(room_id),
+        Body=dumps({'roomId': room_id, 'segments': segments}).encode(),
+        ContentType='application/json',
+        CacheControl='no-cache'
+    )
+
+def drop_archived_partitions(conn, cutoff) -> list:
+    '''Опустевшие месячные секции целиком старше границы удаляются вместе с их индексами'''
+    from psycopg2 import sql
+    
+    dropped = []
+    with conn.cursor() as cur:
+        cur.execute(r'''
+            SELECT c.relname
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'darkhaven_messages'::regclass
+              AND c.relname ~ '^darkhaven_messages_\d{4}_\d{2}$'
+              AND to_date(right(c.relname, 7), 'YYYY_MM') + interval '1 month' <= %s
+            ORDER BY c.relname
+        ''', (cutoff,))
+        partitions = [row[0] for row in cur.fetchall()]
+        
+        for partition in partitions:
+            cur.execute(sql.SQL('SELECT EXISTS (SELECT 1 FROM {})').format(sql.Identifier(partition)))
+            if not cur.fetchone()[0]:
+                cur.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(partition)))
+                dropped.append(partition)
+        conn.commit()
+    
+    return dropped
@@ -0,0 +1,72 @@
+'''Архив истории чата: неизменяемые сегменты NDJSON в S3
+
+Сегменты сжимаются zstd, если установлен zstandard, иначе gzip; кодек
+записывается в манифест, поэтому оба формата читаются одинаково.
+'''
+import gzip
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+from core.codec import dumps, loads
+from core.storage import BUCKET, KEY_PREFIX
+
+ARCHIVE_PREFIX = f'{KEY_PREFIX}/chat-archive'
+ARCHIVE_SEGMENT_CACHE_SIZE = int(os.environ.get('CHAT_ARCHIVE_SEGMENT_CACHE_SIZE', '16'))
+
+try:
+    import zstandard
+    
+    CODEC = 'zst'
+except ImportError:
+    zstandard = None
+    CODEC = 'gz'
+
+def room_prefix(room_id: str) -> str:
+    return f"{ARCHIVE_PREFIX}/{quote(room_id, safe='')}"
+
+def segment_key(room_id: str, first_id: int, last_id: int, codec: str = CODEC) -> str:
+    return f'{room_prefix(room_id)}/{first_id:010d}-{last_id:010d}.ndjson.{codec}'
+
+def manifest_key(room_id: str) -> str:
+    return f'{room_prefix(room_id)}/manifest.json'
+
+def encode_segment(messages: list, codec: str = CODEC) -> bytes:
+    data = ''.join(dumps(message) + '\n' for message in messages).encode()
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=9)
+
+def decode_segment(data: bytes, codec: str) -> list:
+    if codec == 'zst':
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read archived chat segments')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = gzip.decompress(data)
+    return [loads(line) for line in data.decode().splitlines() if line]
+
+class SegmentCache:
+    '''Распакованные сегменты; они неизменяемы, поэтому достаточно LRU без TTL'''
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, s3, key: str, codec: str) -> list:
+        with self._lock:
+            messages = self._segments.get(key)
+            if messages is not None:
+                self._segments.move_to_end(key)
+                return messages
+        
+        body = s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+        messages = decode_segment(body, codec)
+        
+        with self._lock:
+            self._segments[key] = messages
+            if len(self._segments) > self.maxsize:
+                self._segments.popitem(last=False)
+        return messages
@@ -0,0 +1,115 @@
+'''Ограничение частоты запросов: token bucket по токену или IP клиента
+
+Лимиты задаются переменными RATE_LIMIT_<ENDPOINT> в виде "ёмкость/период",
+например RATE_LIMIT_SEND=20/10 — 20 запросов подряд и пополнение 20 штук за
+10 секунд; значение 0 отключает лимит. Бакеты живут в памяти экземпляра;
+с RATE_LIMIT_BACKEND=postgres прошедший локальную проверку запрос ещё и
+сверяется с общим бакетом в UNLOGGED-таблице, так что лимит действует на
+все экземпляры функции сразу.
+
+Ключ по токену годится только вместе с ключом по IP: токен проверяется уже
+после лимита, и клиент, меняющий токен на каждый запрос, иначе каждый раз
+получал бы полный бакет.
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from core.timing import log_event
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '10000'))
+RATE_LIMIT_CLEANUP_INTERVAL = float(os.environ.get('RATE_LIMIT_CLEANUP_INTERVAL', '3600'))
+
+DEFAULT_RATE_LIMITS = {
+    'register': '5/3600',
+    'login': '10/60',
+    'send': '20/10',
+    'send_ip': '40/10',
+    'search': '30/10'
+}
+
+def parse_limit(value: str) -> tuple:
+    if not value or value == '0':
+        return None
+    capacity, _, period = value.partition('/')
+    return float(capacity), float(period or 1)
+
+def client_key(event: dict, token: str = '') -> str:
+    '''Токен хешируется, чтобы он не попадал в таблицу лимитов'''
+    if token:
+        return 't:' + hashlib.sha256(token.encode()).hexdigest()[:32]
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    return 'ip:' + (identity.get('sourceIp') or 'unknown')
+
+class RateLimiter:
+    '''Token bucket для одного эндпоинта; check возвращает Retry-After или None'''
+    
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.limit = parse_limit(os.environ.get(f'RATE_LIMIT_{endpoint.upper()}', DEFAULT_RATE_LIMITS.get(endpoint, '0')))
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._cleaned_at = time.monotonic()
+    
+    def check(self, key: str):
+        if self.limit is None:
+            return None
+        
+        retry_after = self._take_local(key)
+        if retry_after is None and RATE_LIMIT_BACKEND == 'postgres':
+            retry_after = self._take_shared(key)
+        return retry_after
+    
+    def _take_local(self, key: str):
+        capacity, period = self.limit
+        rate = capacity / period
+        now = time.monotonic()
+        
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > RATE_LIMIT_MAX_KEYS:
+                self._buckets.popitem(last=False)
+        
+        return None if allowed else (1 - tokens) / rate
+    
+    def _take_shared(self, key: str):
+        '''Один upsert пополняет и списывает токен; при недоступности БД пропускаем запрос'''
+        import psycopg2
+        from core.db import db_connection
+        
+        capacity, period = self.limit
+        rate = capacity / period
+        
+        try:
+            with db_connection() as conn, conn.cursor() as cur:
+                cur.execute('''
+                    INSERT INTO darkhaven_rate_limits AS b (bucket_key, tokens, updated_at)
+                    VALUES (%s, %s - 1, clock_timestamp())
+                    ON CONFLICT (bucket_key) DO UPDATE
+                    SET tokens = GREATEST(LEAST(%s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %s) - 1, -1),
+                        updated_at = clock_timestamp()
+                    RETURNING tokens
+                ''', (f'{self.endpoint}:{key}', capacity, capacity, rate))
+                tokens = cur.fetchone()[0]
+                
+                if time.monotonic() - self._cleaned_at >= RATE_LIMIT_CLEANUP_INTERVAL:
+                    self._cleaned_at = time.monotonic()
+                    cur.execute('''
+                        DELETE FROM darkhaven_rate_limits
+                        WHERE bucket_key LIKE %s
+                          AND updated_at < clock_timestamp() - make_interval(secs => %s)
+                    ''', (f'{self.endpoint}:%', max(period, RATE_LIMIT_CLEANUP_INTERVAL)))
+                conn.commit()
+        except psycopg2.Error as e:
+            log_event('rateLimit', {'endpoint': self.endpoint, 'error': str(e)})
+            return None
+        
+        return None if tokens >= 0 else (1 - tokens) / rate
@@ -1,33 +1,104 @@
-import json
 import os
-import hashlib
+import sys
 import secrets
+import threading
+import time
 from datetime import datetime, timedelta
 
+# core лежит рядом с index.py: функция разворачивается одним каталогом (см. vendor_core.py)
+FUNCTION_DIR = os.path.dirname(os.path.abspath(__file__))
+if FUNCTION_DIR not in sys.path:
+    sys.path.insert(0, FUNCTION_DIR)
+
+from core.cache import TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, TokenCache, invalidate_user_tokens
+from core.codec import loads
+from core.counters import EXPERIENCE_PER_LEVEL
+from core.db import db_connection
+from core.instrumentation import instrumented
+from core.passwords import dummy_hash, hash_password, run_in_worker, verify_password
+from core.ratelimit import RateLimiter, client_key
+from core.request import get_token, parse_body
+from core.responses import (
+    error_response, preflight_headers, preflight_response, success_response, too_many_requests_response
+)
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, OPTIONS')
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+register_limiter = RateLimiter('register')
+login_limiter = RateLimiter('login')
+
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '60'))
+
+class PresenceTracker:
+    '''Копит heartbeat-отметки в памяти и сбрасывает их в last_seen одним UPDATE'''
+    
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._flushed_at = {}
+        self._lock = threading.Lock()
+    
+    def heartbeat(self, user_id: int) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._pending[user_id] = now
+            return now - self._flushed_at.get(user_id, float('-inf')) >= self.flush_interval
+    
+    def mark_flushed(self, user_id: int):
+        with self._lock:
+            self._pending.pop(user_id, None)
+            self._flushed_at[user_id] = time.monotonic()
+    
+    def flush(self, cur):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        
+        if not pending:
+            return
+        
+        now = time.monotonic()
+        user_ids = list(pending)
+        ages = [now - pending[user_id] for user_id in user_ids]
+        
+        cur.execute('''
+            UPDATE darkhaven_users u
+            SET last_seen = CURRENT_TIMESTAMP - make_interval(secs => v.age)
+            FROM unnest(%s::int[], %s::float8[]) AS v(id, age)
+            WHERE u.id = v.id
+              AND (u.last_seen IS NULL OR u.last_seen < CURRENT_TIMESTAMP - make_interval(secs => v.age))
+        ''', (user_ids, ages))
+        
+        with self._lock:
+            self._flushed_at = {
+                user_id: flushed_at for user_id, flushed_at in self._flushed_at.items()
+                if now - flushed_at < self.flush_interval
+            }
+            self._flushed_at.update(pending)
+
+presence = PresenceTracker(PRESENCE_FLUSH_INTERVAL)
+
+@instrumented('auth')
 def handler(event: dict, context) -> dict:
     '''Система авторизации и регистрации пользователей'''
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return preflight_response(PREFLIGHT_HEADERS)
     
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = parse_body(event)
         action = body.get('action')
         
         if action == 'register':
+            retry_after = register_limiter.check(client_key(event))
+            if retry_after is not None:
+                return too_many_requests_response(retry_after)
             return register_user(body)
         elif action == 'login':
+            retry_after = login_limiter.check(client_key(event))
+            if retry_after is not None:
+                return too_many_requests_response(retry_after)
             return login_user(body)
         elif action == 'verify':
             return verify_token(event)
@@ -39,15 +110,10 @@ def handler(event: dict, context) -> dict:
     except Exception as e:
         return error_response(str(e), 500)
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
-
 def generate_token() -> str:
     return secrets.token_urlsafe(32)
 
 def register_user(data: dict) -> dict:
-    import psycopg2
-    
     username = data.get('username', '').strip()
     password = data.get('password', '')
     email = data.get('email', '').strip()
@@ -61,16 +127,13 @@ def register_user(data: dict) -> dict:
     if len(password) < 4:
         return error_response('Password must be at least 4 characters', 400)
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    password_hash = run_in_worker(hash_password, password)
     
-    try:
+    with db_connection() as conn, conn.cursor() as cur:
         cur.execute("SELECT id FROM darkhaven_users WHERE LOWER(username) = LOWER(%s)", (username,))
         if cur.fetchone():
             return error_response('Username already exists', 409)
         
-        password_hash = hash_password(password)
         token = generate_token()
         
         is_admin = username == 'GameServerX' and password == '4444DIALOG7777777'
@@ -98,136 +161,157 @@ def register_user(data: dict) -> dict:
                 'onlineStatus': user[8]
             }
         })
-        
-    finally:
-        cur.close()
-        conn.close()
 
 def login_user(data: dict) -> dict:
-    import psycopg2
-    
     username = data.get('username', '').strip()
     password = data.get('password', '')
     
     if not username or not password:
         return error_response('Username and password required', 400)
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    try:
-        password_hash = hash_password(password)
-        
+    with db_connection() as conn, conn.cursor() as cur:
         cur.execute('''
-            SELECT id, username, email, is_admin, token, avatar_url, bio, level, experience, 
-                   total_messages, total_time_online, achievements, friends, online_status
-            FROM darkhaven_users 
-            WHERE LOWER(username) = LOWER(%s) AND password_hash = %s
-        ''', (username, password_hash))
+            SELECT u.id, u.username, u.email, u.is_admin, u.password_hash, u.avatar_url, u.bio,
+                   CASE WHEN p.experience > 0 THEN (u.experience + p.experience) / %s + 1 ELSE u.level END,
+                   u.experience + p.experience, u.total_messages + p.messages, u.total_time_online, u.achievements,
+                   ARRAY(SELECT friend_id FROM darkhaven_friendships WHERE user_id = u.id ORDER BY friend_id),
+                   u.online_status
+            FROM darkhaven_users u
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(SUM(messages), 0) AS messages, COALESCE(SUM(experience), 0) AS experience
+                FROM darkhaven_user_counter_deltas WHERE user_id = u.id
+            ) p
+            WHERE LOWER(u.username) = LOWER(%s)
+        ''', (EXPERIENCE_PER_LEVEL, username))
         
         user = cur.fetchone()
-        
-        if not user:
-            return error_response('Invalid username or password', 401)
-        
-        new_token = generate_token()
-        cur.execute('UPDATE darkhaven_users SET token = %s, last_login = CURRENT_TIMESTAMP, online_status = %s WHERE id = %s', 
-                   (new_token, 'online', user[0]))
+    
+    valid, needs_rehash = run_in_worker(verify_password, password, user[4] if user else dummy_hash())
+    
+    if not user or not valid:
+        return error_response('Invalid username or password', 401)
+    
+    new_password_hash = run_in_worker(hash_password, password) if needs_rehash else None
+    new_token = generate_token()
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            UPDATE darkhaven_users
+            SET token = %s, last_login = CURRENT_TIMESTAMP, last_seen = CURRENT_TIMESTAMP,
+                online_status = %s, password_hash = COALESCE(%s, password_hash)
+            WHERE id = %s
+        ''', (new_token, 'online', new_password_hash, user[0]))
         conn.commit()
-        
-        return success_response({
-            'token': new_token,
-            'user': {
-                'id': user[0],
-                'username': user[1],
-                'email': user[2],
-                'isAdmin': user[3],
-                'avatarUrl': user[5],
-                'bio': user[6],
-                'level': user[7],
-                'experience': user[8],
-                'totalMessages': user[9],
-                'totalTimeOnline': user[10],
-                'achievements': json.loads(user[11]) if user[11] else [],
-                'friends': json.loads(user[12]) if user[12] else [],
-                'onlineStatus': 'online'
-            }
-        })
-        
-    finally:
-        cur.close()
-        conn.close()
+    
+    presence.mark_flushed(user[0])
+    
+    user_data = {
+        'id': user[0],
+        'username': user[1],
+        'email': user[2],
+        'isAdmin': user[3],
+        'avatarUrl': user[5],
+        'bio': user[6],
+        'level': user[7],
+        'experience': user[8],
+        'totalMessages': user[9],
+        'totalTimeOnline': user[10],
+        'achievements': loads(user[11]) if user[11] else [],
+        'friends': user[12],
+        'onlineStatus': 'online'
+    }
+    
+    invalidate_user_tokens(user[0])
+    token_cache.put(new_token, user_data)
+    
+    return success_response({
+        'token': new_token,
+        'user': user_data
+    })
 
-def verify_token(event: dict) -> dict:
-    import psycopg2
+def get_user_from_token(cur, token: str):
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+    return load_user_by_token(cur, token)
+
+def load_user_by_token(cur, token: str):
+    cur.execute('''
+        SELECT u.id, u.username, u.email, u.is_admin, u.avatar_url, u.bio,
+               CASE WHEN p.experience > 0 THEN (u.experience + p.experience) / %s + 1 ELSE u.level END,
+               u.experience + p.experience, u.total_messages + p.messages, u.total_time_online, u.achievements,
+               ARRAY(SELECT friend_id FROM darkhaven_friendships WHERE user_id = u.id ORDER BY friend_id),
+               u.online_status
+        FROM darkhaven_users u
+        CROSS JOIN LATERAL (
+            SELECT COALESCE(SUM(messages), 0) AS messages, COALESCE(SUM(experience), 0) AS experience
+            FROM darkhaven_user_counter_deltas WHERE user_id = u.id
+        ) p
+        WHERE u.token = %s
+    ''', (EXPERIENCE_PER_LEVEL, token))
     
-    token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
+    row = cur.fetchone()
+    
+    if not row:
+        return None
+    
+    user = {
+        'id': row[0],
+        'username': row[1],
+        'email': row[2],
+        'isAdmin': row[3],
+        'avatarUrl': row[4],
+        'bio': row[5],
+        'level': row[6],
+        'experience': row[7],
+        'totalMessages': row[8],
+        'totalTimeOnline': row[9],
+        'achievements': loads(row[10]) if row[10] else [],
+        'friends': row[11],
+        'onlineStatus': row[12]
+    }
+    token_cache.put(token, user)
+    return user
+
+def verify_token(event: dict) -> dict:
+    token = get_token(event)
     
     if not token:
         return error_response('Token required', 401)
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    user = token_cache.get(token)
+    if user is not None and not presence.heartbeat(user['id']):
+        return success_response({'user': user})
     
-    try:
-        cur.execute('''
-            SELECT id, username, email, is_admin, avatar_url, bio, level, experience,
-                   total_messages, total_time_online, achievements, friends, online_status
-            FROM darkhaven_users WHERE token = %s
-        ''', (token,))
-        
-        user = cur.fetchone()
-        
-        if not user:
-            return error_response('Invalid token', 401)
+    with db_connection() as conn, conn.cursor() as cur:
+        if user is None:
+            user = load_user_by_token(cur, token)
+            
+            if not user:
+                return error_response('Invalid token', 401)
+            
+            if not presence.heartbeat(user['id']):
+                return success_response({'user': user})
         
-        cur.execute('UPDATE darkhaven_users SET last_seen = CURRENT_TIMESTAMP WHERE id = %s', (user[0],))
+        presence.flush(cur)
         conn.commit()
-        
-        return success_response({
-            'user': {
-                'id': user[0],
-                'username': user[1],
-                'email': user[2],
-                'isAdmin': user[3],
-                'avatarUrl': user[4],
-                'bio': user[5],
-                'level': user[6],
-                'experience': user[7],
-                'totalMessages': user[8],
-                'totalTimeOnline': user[9],
-                'achievements': json.loads(user[10]) if user[10] else [],
-                'friends': json.loads(user[11]) if user[11] else [],
-                'onlineStatus': user[12]
-            }
-        })
-        
-    finally:
-        cur.close()
-        conn.close()
+    
+    return success_response({'user': user})
 
 def update_profile(event: dict, data: dict) -> dict:
-    import psycopg2
-    
-    token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
+    token = get_token(event)
     
     if not token:
         return error_response('Token required', 401)
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    try:
-        cur.execute('SELECT id FROM darkhaven_users WHERE token = %s', (token,))
-        user = cur.fetchone()
+    with db_connection() as conn, conn.cursor() as cur:
+        user = get_user_from_token(cur, token)
         
         if not user:
             return error_response('Invalid token', 401)
         
-        user_id = user[0]
+        user_id = user['id']
+        pending = ''
         updates = []
         values = []
         
@@ -247,37 +331,22 @@ def update_profile(event: dict, data: dict) -> dict:
             updates.append('experience = %s')
             values.append(data['experience'])
             updates.append('level = %s')
-            values.append(data['experience'] // 100 + 1)
+            values.append(data['experience'] // EXPERIENCE_PER_LEVEL + 1)
+            # Опыт задан абсолютно: отложенные приросты забираем тем же запросом,
+            # иначе свёртка добавила бы старые отправки поверх нового значения.
+            # Счётчик сообщений при этом переносим, а не теряем
+            pending = '''
+                WITH pending AS (
+                    DELETE FROM darkhaven_user_counter_deltas WHERE user_id = %s RETURNING messages
+                )
+            '''
+            values.insert(0, user_id)
+            updates.append('total_messages = total_messages + (SELECT COALESCE(SUM(messages), 0) FROM pending)')
         
         if updates:
             values.append(user_id)
-            cur.execute(f"UPDATE darkhaven_users SET {', '.join(updates)} WHERE id = %s", values)
+            cur.execute(f"{pending} UPDATE darkhaven_users SET {', '.join(updates)} WHERE id = %s", values)
             conn.commit()
+            invalidate_user_tokens(user_id)
         
         return success_response({'message': 'Profile updated'})
-        
-    finally:
-        cur.close()
-        conn.close()
-
-def success_response(data: dict) -> dict:
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps(data),
-        'isBase64Encoded': False
-    }
-
-def error_response(message: str, status_code: int) -> dict:
-    return {
-        'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({'error': message}),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
@@ -0,0 +1 @@
+'''Бенчмарки обработчиков, запускаются локально'''
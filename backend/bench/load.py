@@ -0,0 +1,251 @@
+'''Нагрузочный прогон обработчиков auth, chat, users и upload в одном процессе
+
+Нужны локальный PostgreSQL и S3: по умолчанию S3 подменяется moto,
+для MinIO задайте S3_ENDPOINT и ключи доступа.
+
+Запуск из каталога backend:
+    BENCH_DATABASE_URL=postgresql://localhost/darkhaven_bench \\
+        python -m bench.load --reset --users 1000 --messages 50000 --requests 500 --concurrency 8
+
+--reset пересоздаёт схему public в базе BENCH_DATABASE_URL, поэтому
+никогда не указывайте рабочую базу.
+'''
+import argparse
+import base64
+import importlib.util
+import io
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(BACKEND_DIR), 'db_migrations')
+SCENARIOS = ('register', 'login', 'verify', 'send', 'fetch', 'search', 'upload')
+BENCH_PASSWORD = 'bench-password'
+USERNAME_PREFIX = 'bench_user_'
+
+_queries = threading.local()
+
+def counted_queries() -> int:
+    return getattr(_queries, 'count', 0)
+
+def reset_counted_queries():
+    _queries.count = 0
+
+def make_counting_cursor():
+    from psycopg2.extensions import cursor
+
+    class CountingCursor(cursor):
+        '''Считает запросы текущего потока, чтобы получить queries-per-request'''
+        def execute(self, query, vars=None):
+            _queries.count = counted_queries() + 1
+            return super().execute(query, vars)
+
+        def executemany(self, query, vars_list):
+            _queries.count = counted_queries() + 1
+            return super().executemany(query, vars_list)
+
+    return CountingCursor
+
+def load_handler(name: str):
+    path = os.path.join(BACKEND_DIR, name, 'index.py')
+    spec = importlib.util.spec_from_file_location(f'bench_{name}_index', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.handler
+
+def reset_schema(conn):
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public')
+        for file_name in sorted(os.listdir(MIGRATIONS_DIR)):
+            if file_name.endswith('.sql'):
+                with open(os.path.join(MIGRATIONS_DIR, file_name), encoding='utf-8') as migration:
+                    cur.execute(migration.read())
+    conn.commit()
+
+def seed(conn, users: int, messages: int):
+    from core.passwords import hash_password
+
+    password_hash = hash_password(BENCH_PASSWORD)
+    with conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO darkhaven_users (username, password_hash, email, token, last_seen)
+            SELECT %s || i, %s, %s || i || '@bench.local', 'bench-token-' || i, CURRENT_TIMESTAMP
+            FROM generate_series(0, %s - 1) AS i
+            ON CONFLICT (username) DO UPDATE SET token = EXCLUDED.token, password_hash = EXCLUDED.password_hash
+        ''', (USERNAME_PREFIX, password_hash, USERNAME_PREFIX, users))
+        cur.execute('''
+            INSERT INTO darkhaven_messages (user_id, message, created_at)
+            SELECT u.id, 'bench message ' || i, CURRENT_TIMESTAMP - make_interval(secs => %s - i)
+            FROM generate_series(0, %s - 1) AS i
+            JOIN darkhaven_users u ON u.username = %s || (i %% %s)
+        ''', (messages, messages, USERNAME_PREFIX, users))
+    conn.commit()
+
+def start_s3():
+    '''moto поднимается в процессе, если не указан внешний S3 (например, MinIO)'''
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    mock = None
+    if 'S3_ENDPOINT' not in os.environ:
+        os.environ['S3_ENDPOINT'] = 'http://s3.bench.local'
+        os.environ['MOTO_S3_CUSTOM_ENDPOINTS'] = os.environ['S3_ENDPOINT']
+        from moto import mock_aws
+        mock = mock_aws()
+        mock.start()
+
+    import boto3
+    s3 = boto3.client('s3', endpoint_url=os.environ['S3_ENDPOINT'])
+    try:
+        s3.create_bucket(Bucket='files')
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    return mock
+
+def sample_image(index: int) -> str:
+    '''Каждый запрос загружает новое содержимое, чтобы не мерить только дедупликацию'''
+    try:
+        from PIL import Image
+    except ImportError:
+        return base64.b64encode(os.urandom(64 * 1024)).decode()
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (800, 600), (index % 256, index // 256 % 256, 128)).save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+def build_events(users: int, run_id: str) -> dict:
+    '''Первая половина пользователей — держатели токенов, вторая — для входа (вход меняет токен)'''
+    half = max(users // 2, 1)
+
+    def token_headers(i):
+        return {'X-Authorization': f'Bearer bench-token-{i % half}'}
+
+    return {
+        'register': ('auth', lambda i: {
+            'httpMethod': 'POST',
+            'body': f'{{"action": "register", "username": "bench_{run_id}_{i}", "password": "{BENCH_PASSWORD}"}}'
+        }),
+        'login': ('auth', lambda i: {
+            'httpMethod': 'POST',
+            'body': f'{{"action": "login", "username": "{USERNAME_PREFIX}{half + i % max(users - half, 1)}", "password": "{BENCH_PASSWORD}"}}'
+        }),
+        'verify': ('auth', lambda i: {
+            'httpMethod': 'POST',
+            'headers': token_headers(i),
+            'body': '{"action": "verify"}'
+        }),
+        'send': ('chat', lambda i: {
+            'httpMethod': 'POST',
+            'headers': token_headers(i),
+            'body': f'{{"message": "load {run_id} #{i}"}}'
+        }),
+        'fetch': ('chat', lambda i: {
+            'httpMethod': 'GET',
+            'queryStringParameters': {}
+        }),
+        'search': ('users', lambda i: {
+            'httpMethod': 'GET',
+            'queryStringParameters': {'search': f'user_{i % 100}'}
+        }),
+        'upload': ('upload', lambda i: {
+            'httpMethod': 'POST',
+            'body': f'{{"action": "upload", "fileName": "bench.png", "file": "{sample_image(i)}"}}'
+        })
+    }
+
+def call(handler, event: dict) -> tuple:
+    reset_counted_queries()
+    started = time.perf_counter()
+    try:
+        status = handler(event, None)['statusCode']
+    except Exception:
+        status = None
+    return (time.perf_counter() - started) * 1000, status, counted_queries()
+
+def run_scenario(handler, make_event, requests: int, concurrency: int, warmup: int) -> dict:
+    for i in range(warmup):
+        call(handler, make_event(requests + i))
+
+    events = [make_event(i) for i in range(requests)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as workers:
+        results = list(workers.map(lambda event: call(handler, event), events))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(result[0] for result in results)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, status, _ in results if status is None or status >= 400),
+        'rps': requests / wall if wall else 0.0,
+        'p50': percentiles[49],
+        'p95': percentiles[94],
+        'p99': percentiles[98],
+        'queries': sum(result[2] for result in results) / requests
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=500, help='запросов на сценарий')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--reset', action='store_true', help='пересоздать схему и заново засеять данные')
+    parser.add_argument('--only', nargs='*', choices=SCENARIOS, default=list(SCENARIOS))
+    args = parser.parse_args()
+
+    dsn = os.environ.get('BENCH_DATABASE_URL')
+    if not dsn:
+        sys.exit('BENCH_DATABASE_URL is required (a throwaway database, never production)')
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('DB_POOL_MAX', str(max(args.concurrency, 5)))
+    
+    from core.ratelimit import DEFAULT_RATE_LIMITS
+    for endpoint in DEFAULT_RATE_LIMITS:
+        os.environ.setdefault(f'RATE_LIMIT_{endpoint.upper()}', '0')
+
+    import psycopg2
+    from core import db
+
+    if args.reset:
+        conn = psycopg2.connect(dsn)
+        try:
+            reset_schema(conn)
+            seed(conn, max(args.users, 2), args.messages)
+        finally:
+            conn.close()
+
+    db.configure_connections(cursor_factory=make_counting_cursor())
+    mock = start_s3() if 'upload' in args.only else None
+
+    run_id = uuid.uuid4().hex[:8]
+    events = build_events(max(args.users, 2), run_id)
+    handlers = {}
+
+    print(f'{"scenario":<10}{"requests":>9}{"errors":>8}{"rps":>9}{"p50, ms":>10}{"p95, ms":>10}{"p99, ms":>10}{"q/req":>7}')
+    try:
+        for name in args.only:
+            function, make_event = events[name]
+            if function not in handlers:
+                handlers[function] = load_handler(function)
+            stats = run_scenario(handlers[function], make_event, args.requests, args.concurrency, args.warmup)
+            print(f'{name:<10}{stats["requests"]:>9}{stats["errors"]:>8}{stats["rps"]:>9.1f}'
+                  f'{stats["p50"]:>10.2f}{stats["p95"]:>10.2f}{stats["p99"]:>10.2f}{stats["queries"]:>7.2f}')
+    finally:
+        if mock is not None:
+            mock.stop()
+
+    print(f'users={args.users} messages={args.messages} concurrency={args.concurrency} pool max={db.DB_POOL_MAX}')
+
+if __name__ == '__main__':
+    main()
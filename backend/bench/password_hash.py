@@ -0,0 +1,47 @@
+'''Задержка входа при разной стоимости scrypt и поведение при всплеске входов
+
+Запуск из каталога backend: python -m bench.password_hash
+'''
+import hashlib
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from core import passwords
+
+COSTS = (2 ** 12, 2 ** 13, 2 ** 14, 2 ** 15, 2 ** 16)
+SAMPLES = 10
+BURST = 16
+
+def time_ms(func, *args) -> float:
+    started = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - started) * 1000
+
+def main():
+    legacy = hashlib.sha256(b'password').hexdigest()
+    legacy_ms = statistics.median(time_ms(passwords.verify_password, 'password', legacy) for _ in range(SAMPLES))
+    print(f'legacy sha256 verify: {legacy_ms:.3f} ms')
+    print(f'{"N":>8}{"verify p50, ms":>16}{"burst of " + str(BURST) + ", ms":>18}')
+    
+    for n in COSTS:
+        stored = passwords.hash_password('password', n)
+        verify_ms = statistics.median(time_ms(passwords.verify_password, 'password', stored) for _ in range(SAMPLES))
+        
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=BURST) as clients:
+            list(clients.map(lambda _: passwords.run_in_worker(passwords.verify_password, 'password', stored), range(BURST)))
+        burst_ms = (time.perf_counter() - started) * 1000
+        
+        print(f'{n:>8}{verify_ms:>16.1f}{burst_ms:>18.1f}')
+    
+    print(f'hash workers: {passwords.PASSWORD_HASH_WORKERS}, current cost N={passwords.PASSWORD_SCRYPT_N}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''Стоимость сериализации ответов: stdlib json с isoformat против кодека core.codec
+
+Запуск из каталога backend: python -m bench.serialization
+'''
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from core import codec
+
+AUTHORS = 5
+
+def make_rows(count: int) -> list:
+    started = datetime(2024, 1, 1, 12, 0, 0)
+    return [
+        (i, i % AUTHORS + 1, f'Сообщение номер {i} в общем чате Dark Haven', started + timedelta(seconds=i, microseconds=i), False)
+        for i in range(1, count + 1)
+    ]
+
+def make_author(user_id: int) -> dict:
+    return {
+        'id': user_id,
+        'username': f'player{user_id}',
+        'avatarUrl': f'https://api.dicebear.com/7.x/avataaars/svg?seed={user_id}',
+        'isAdmin': False,
+        'level': 7,
+        'onlineStatus': 'online'
+    }
+
+def messages_before(rows: list) -> str:
+    messages = []
+    for row in rows:
+        messages.append({
+            'id': row[0],
+            'message': row[2],
+            'timestamp': row[3].isoformat(),
+            'edited': row[4],
+            'user': make_author(row[1])
+        })
+    return json.dumps({'messages': messages})
+
+def messages_after(rows: list) -> str:
+    users = {user_id: make_author(user_id) for user_id in {row[1] for row in rows}}
+    messages = [
+        {'id': row[0], 'userId': row[1], 'message': row[2], 'timestamp': row[3], 'edited': row[4]}
+        for row in rows
+    ]
+    return codec.dumps({'messages': messages, 'users': users})
+
+def make_profile_row() -> tuple:
+    now = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    return (1, 'player1', 'p1@example.com', 'https://example.com/a.png', 'bio', 7, 640,
+            64, 3600, ['first_message'], list(range(1, 51)), 'online', now, now, now)
+
+def profile_before(user: tuple) -> str:
+    return json.dumps({'user': {
+        'id': user[0], 'username': user[1], 'email': user[2], 'avatarUrl': user[3], 'bio': user[4],
+        'level': user[5], 'experience': user[6], 'totalMessages': user[7], 'totalTimeOnline': user[8],
+        'achievements': user[9], 'friends': user[10], 'onlineStatus': user[11],
+        'createdAt': user[12].isoformat(),
+        'lastLogin': user[13].isoformat() if user[13] else None,
+        'lastSeen': user[14].isoformat() if user[14] else None
+    }})
+
+def profile_after(user: tuple) -> str:
+    return codec.dumps({'user': {
+        'id': user[0], 'username': user[1], 'email': user[2], 'avatarUrl': user[3], 'bio': user[4],
+        'level': user[5], 'experience': user[6], 'totalMessages': user[7], 'totalTimeOnline': user[8],
+        'achievements': user[9], 'friends': user[10], 'onlineStatus': user[11],
+        'createdAt': user[12], 'lastLogin': user[13], 'lastSeen': user[14]
+    }})
+
+def measure(func, arg, number: int) -> float:
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number * 1e6
+
+def main():
+    print(f'codec backend: {codec.BACKEND}')
+    print(f'{"response":<22}{"before, us":>12}{"after, us":>12}{"bytes before":>14}{"bytes after":>13}')
+    
+    cases = [
+        ('get_messages x50', messages_before, messages_after, make_rows(50), 2000),
+        ('get_messages x200', messages_before, messages_after, make_rows(200), 500),
+        ('get_user_profile', profile_before, profile_after, make_profile_row(), 20000)
+    ]
+    for name, before, after, arg, number in cases:
+        print(f'{name:<22}{measure(before, arg, number):>12.1f}{measure(after, arg, number):>12.1f}'
+              f'{len(before(arg).encode()):>14}{len(after(arg).encode()):>13}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''Кэш пользователей по токену сессии'''
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from core.timing import log_event
+
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '1024'))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', '30'))
+TOKEN_CACHE_PEER_TTL = float(os.environ.get('TOKEN_CACHE_PEER_TTL', '5'))
+TOKEN_CACHE_LOG_EVERY = int(os.environ.get('TOKEN_CACHE_LOG_EVERY', '1000'))
+
+_caches = weakref.WeakSet()
+
+def invalidate_user_tokens(user_id: int):
+    '''Сбрасывает токены пользователя во всех кэшах процесса
+
+    В облаке у каждой функции свой процесс, и вход в auth не доходит до кэшей
+    chat и users, поэтому там используется короткий TOKEN_CACHE_PEER_TTL.
+    В общем сервере (python -m server) сброс сразу виден всем функциям.
+    '''
+    for cache in list(_caches):
+        cache.invalidate_user(user_id)
+
+class TokenCache:
+    '''LRU-кэш пользователей по токену с ограниченным временем жизни записи'''
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tokens_by_user = {}
+        self._lock = threading.Lock()
+        _caches.add(self)
+    
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(token)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(token)
+                self.hits += 1
+            lookups = self.hits + self.misses
+        
+        if TOKEN_CACHE_LOG_EVERY and lookups % TOKEN_CACHE_LOG_EVERY == 0:
+            log_event('tokenCache', self.stats())
+        
+        return entry[1] if entry else None
+    
+    def put(self, token: str, user: dict):
+        if self.maxsize <= 0:
+            return
+        
+        with self._lock:
+            if token in self._entries:
+                self._drop(token)
+            self._entries[token] = (time.monotonic() + self.ttl, user)
+            self._tokens_by_user.setdefault(user['id'], set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+    
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._drop(token)
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+    
+    def _drop(self, token: str):
+        _, user = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user['id'])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user['id']]
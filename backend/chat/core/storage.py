@@ -0,0 +1,51 @@
+'''Клиент S3-совместимого хранилища, общий для загрузок и архива чата'''
+import os
+import threading
+import time
+
+from core.timing import elapsed_ms
+
+S3_ENDPOINT = os.environ.get('S3_ENDPOINT', 'https://bucket.poehali.dev')
+BUCKET = 'files'
+KEY_PREFIX = 'dark-haven'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '10'))
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', '3'))
+
+_s3_client = None
+_s3_lock = threading.Lock()
+s3_setup_timings = {}
+
+def s3_client_ready() -> bool:
+    return _s3_client is not None
+
+def get_s3_client():
+    '''Клиент S3 создаётся один раз и переиспользуется тёплыми вызовами'''
+    global _s3_client
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                started = time.perf_counter()
+                import boto3
+                from botocore.config import Config
+                imported = time.perf_counter()
+                
+                _s3_client = boto3.client('s3',
+                    endpoint_url=S3_ENDPOINT,
+                    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'},
+                        connect_timeout=5,
+                        read_timeout=60,
+                        tcp_keepalive=True
+                    )
+                )
+                
+                s3_setup_timings['importMs'] = round((imported - started) * 1000, 2)
+                s3_setup_timings['clientMs'] = elapsed_ms(imported)
+    return _s3_client
+
+def cdn_url(key: str) -> str:
+    return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
@@ -1,23 +1,420 @@
-import json
+import math
 import os
+import sys
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
+# core лежит рядом с index.py: функция разворачивается одним каталогом (см. vendor_core.py)
+FUNCTION_DIR = os.path.dirname(os.path.abspath(__file__))
+if FUNCTION_DIR not in sys.path:
+    sys.path.insert(0, FUNCTION_DIR)
+
+from core.archive import ARCHIVE_SEGMENT_CACHE_SIZE, SegmentCache
+from core.cache import TOKEN_CACHE_PEER_TTL, TOKEN_CACHE_SIZE, TokenCache
+from core.counters import COUNTER_FOLD_INTERVAL, EXPERIENCE_PER_MESSAGE, CounterFolder
+from core.db import db_connection, get_dsn
+from core.instrumentation import instrumented
+from core.ratelimit import RateLimiter, client_key
+from core.request import etag_matches, get_query_params, get_token, parse_body
+from core.responses import (
+    error_response, etag_headers, no_content_response, not_modified_response,
+    preflight_headers, preflight_response, success_response, too_many_requests_response
+)
+from core.storage import get_s3_client
+from core.timing import log_event
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, DELETE, OPTIONS')
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_PEER_TTL)
+send_limiter = RateLimiter('send')
+send_ip_limiter = RateLimiter('send_ip')
+counter_folder = CounterFolder(COUNTER_FOLD_INTERVAL)
+
+MAX_MESSAGES_LIMIT = 200
+MESSAGES_CHANNEL = 'darkhaven_messages'
+MAX_WAIT_SECONDS = 25
+LISTEN_READY_TIMEOUT = 5
+DEFAULT_ROOM = 'general'
+MAX_ROOM_ID_LENGTH = 100
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_CHECK_INTERVAL = 6 * 3600
+PARTITION_LOCK = 0x6468_0002
+
+class MessageListener:
+    '''Одно LISTEN-соединение на экземпляр будит все ожидающие long-poll запросы'''
+    
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.latest_ids = {}
+        self._ready = threading.Event()
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def ensure_listening(self) -> bool:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._ready.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return self._ready.wait(LISTEN_READY_TIMEOUT)
+    
+    def latest_id(self, room_id: str) -> int:
+        '''Наибольший id из уведомлений; после удаления сообщения он может быть уже удалённым'''
+        return self.latest_ids.get(room_id, 0)
+    
+    def wait_for(self, room_id: str, since_id: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.latest_id(room_id) <= since_id:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+    
+    def publish(self, latest: dict):
+        with self._cond:
+            for room_id, message_id in latest.items():
+                if message_id > self.latest_id(room_id):
+                    self.latest_ids[room_id] = message_id
+            self._cond.notify_all()
+    
+    def _run(self):
+        import select
+        import psycopg2
+        
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(get_dsn())
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {self.channel}')
+                self._ready.set()
+                
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    latest = {}
+                    for notify in conn.notifies:
+                        message_id, _, room_id = notify.payload.partition(':')
+                        if message_id.isdigit():
+                            latest[room_id] = max(latest.get(room_id, 0), int(message_id))
+                    conn.notifies.clear()
+                    if latest:
+                        self.publish(latest)
+            except (psycopg2.Error, OSError):
+                self._ready.clear()
+                time.sleep(1)
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
+
+message_listener = MessageListener(MESSAGES_CHANNEL)
+
+ROOMS_CACHE_TTL = float(os.environ.get('CHAT_ROOMS_CACHE_TTL', '60'))
+ROOM_IDS_SQL = 'SELECT id FROM darkhaven_chat_rooms'
+
+class KnownRooms:
+    '''id комнат из darkhaven_chat_rooms: чтение неизвестной комнаты не заводит ей буфер
+
+    Список перечитывается не чаще раза в ROOMS_CACHE_TTL, так что поток выдуманных
+    room_id не ходит в БД на каждый запрос. Комната, куда удалось отправить
+    сообщение, добавляется сразу.
+    '''
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.room_ids = frozenset()
+        self.loaded_at = float('-inf')
+        self._lock = threading.Lock()
+    
+    def stale(self) -> bool:
+        return time.monotonic() - self.loaded_at > self.ttl
+    
+    def load(self, room_ids):
+        with self._lock:
+            self.room_ids = frozenset(room_ids)
+            self.loaded_at = time.monotonic()
+    
+    def add(self, room_id: str):
+        with self._lock:
+            self.room_ids = self.room_ids | {room_id}
+    
+    def __contains__(self, room_id: str) -> bool:
+        return room_id in self.room_ids
+
+known_rooms = KnownRooms(ROOMS_CACHE_TTL)
+
+def room_exists(room_id: str) -> bool:
+    if known_rooms.stale():
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(ROOM_IDS_SQL)
+            known_rooms.load(row[0] for row in cur.fetchall())
+    return room_id in known_rooms
+
+RING_BUFFER_SIZE = int(os.environ.get('CHAT_RING_BUFFER_SIZE', '200'))
+RING_BUFFER_MAX_STALENESS = float(os.environ.get('CHAT_RING_BUFFER_MAX_STALENESS', '1'))
+MAX_BUFFERED_ROOMS = int(os.environ.get('CHAT_MAX_BUFFERED_ROOMS', '16'))
+
+class RecentMessages:
+    '''Последние сообщения комнаты в памяти экземпляра, сверяемые с версией в БД'''
+    
+    def __init__(self, room_id: str, capacity: int):
+        self.room_id = room_id
+        self.capacity = capacity
+        self.messages = []
+        self.users = {}
+        self.version = None
+        self.synced_max_id = 0
+        self.notified_id = 0
+        self.complete = False
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+    
+    def fresh_version(self):
+        with self._lock:
+            if self.version is None:
+                return None
+            if time.monotonic() - self.checked_at > RING_BUFFER_MAX_STALENESS:
+                return None
+            if message_listener.latest_id(self.room_id) > max(self.version[0], self.notified_id):
+                return None
+            return self.version
+    
+    def sync(self, cur) -> tuple:
+        notified_id = message_listener.latest_id(self.room_id)
+        version = read_chat_version(cur, self.room_id)
+        
+        with self._lock:
+            plan = self._plan_sync(version)
+            replace, since_id, author_ids = plan
+            page = authors = None
+            if since_id is not None:
+                page = fetch_messages_page(cur, self.room_id, 'AND m.id > %s', 'ASC', (since_id, self.capacity + 1))
+                if len(page[0]) > self.capacity:
+                    replace, page = True, None
+            if replace:
+                page = fetch_messages_page(cur, self.room_id, '', 'DESC', (self.capacity,))
+            elif author_ids:
+                authors = fetch_authors(cur, author_ids)
+            return self._apply_sync(version, replace, page, authors, notified_id)
+    
+    def plan_sync(self, version: tuple) -> tuple:
+        '''Что дочитать из БД до version: (перечитать целиком, новее какого id, чьих авторов обновить)
+
+        Для асинхронного сервера: чтение идёт без блокировки буфера, а apply_sync
+        применяет результат, только если буфер за это время не менялся.
+        '''
+        with self._lock:
+            return self._plan_sync(version)
+    
+    def apply_sync(self, version: tuple, plan: tuple, replace: bool, page=None, authors=None, notified_id: int = 0):
+        with self._lock:
+            if self._plan_sync(version) != plan:
+                return None
+            return self._apply_sync(version, replace, page, authors, notified_id)
+    
+    def _plan_sync(self, version: tuple) -> tuple:
+        if self.version is None or version[1] != self.version[1]:
+            return True, None, None
+        since_id = self.synced_max_id if version[0] > self.synced_max_id else None
+        author_ids = tuple(sorted(self.users)) if version[2] != self.version[2] and self.users else None
+        return False, since_id, author_ids
+    
+    def _apply_sync(self, version: tuple, replace: bool, page, authors, notified_id: int) -> tuple:
+        if replace:
+            self.messages, self.users = page
+            self.complete = len(self.messages) < self.capacity
+            self.synced_max_id = 0
+        else:
+            if authors is not None:
+                self.users = authors
+            if page is not None:
+                self.users.update(page[1])
+                self._merge(page[0])
+        
+        self.version = (max(version[0], self.version[0]) if self.version else version[0],
+                        version[1], version[2])
+        self.synced_max_id = max(self.synced_max_id, version[0])
+        # id из уведомлений, прочитанный до версии: если он выше версии, это
+        # удалённое сообщение, и буфер из-за него не должен считаться устаревшим
+        self.notified_id = notified_id
+        self.checked_at = time.monotonic()
+        return self.version
+    
+    def page(self, limit: int, since_id: int = None, before_id: int = None):
+        with self._lock:
+            if self.version is None:
+                return None
+            
+            messages = self.messages
+            oldest_id = messages[0]['id'] if messages else None
+            
+            if since_id is not None:
+                if not self.complete and (oldest_id is None or since_id < oldest_id - 1):
+                    return None
+                selected = [m for m in messages if m['id'] > since_id][:limit]
+            else:
+                if before_id is not None:
+                    messages = [m for m in messages if m['id'] < before_id]
+                if len(messages) < limit and not self.complete:
+                    return None
+                selected = messages[-limit:]
+            
+            users = {m['userId']: self.users[m['userId']] for m in selected if m['userId'] in self.users}
+            return [m for m in selected if m['userId'] in users], users
+    
+    def append(self, message: dict, user: dict):
+        with self._lock:
+            if self.version is None:
+                return
+            self._merge([message])
+            self.users[user['id']] = user
+            if message['id'] == self.synced_max_id + 1:
+                self.synced_max_id = message['id']
+                self.version = (max(self.version[0], message['id']), self.version[1], self.version[2])
+            else:
+                # Между синхронизацией и этим сообщением могли закоммитить другие:
+                # без них since_id-страница перескочила бы пропуск, поэтому следующее
+                # чтение сверится с БД
+                self.checked_at = 0.0
+    
+    def remove(self, message_id: int, messages_version: int):
+        with self._lock:
+            if self.version is None or messages_version != self.version[1] + 1:
+                self.version = None
+                return
+            self.messages = [m for m in self.messages if m['id'] != message_id]
+            self.version = (self.version[0], messages_version, self.version[2])
+    
+    def _merge(self, messages: list):
+        known_ids = {m['id'] for m in self.messages}
+        self.messages.extend(m for m in messages if m['id'] not in known_ids)
+        self.messages.sort(key=lambda m: m['id'])
+        if len(self.messages) > self.capacity:
+            self.messages = self.messages[-self.capacity:]
+            self.complete = False
+            live_ids = {m['userId'] for m in self.messages}
+            self.users = {uid: user for uid, user in self.users.items() if uid in live_ids}
+
+_room_buffers = OrderedDict()
+_room_buffers_lock = threading.Lock()
+
+def recent_messages_for(room_id: str) -> RecentMessages:
+    '''Буферы держатся только для последних активных комнат'''
+    with _room_buffers_lock:
+        buffer = _room_buffers.get(room_id)
+        if buffer is None:
+            buffer = _room_buffers[room_id] = RecentMessages(room_id, RING_BUFFER_SIZE)
+            if len(_room_buffers) > MAX_BUFFERED_ROOMS:
+                _room_buffers.popitem(last=False)
+        else:
+            _room_buffers.move_to_end(room_id)
+        return buffer
+
+segment_cache = SegmentCache(ARCHIVE_SEGMENT_CACHE_SIZE)
+_archive_manifests = OrderedDict()
+_archive_manifests_lock = threading.Lock()
+
+def archived_segments(room_id: str, messages_version: int) -> list:
+    '''Архивация удаляет строки и тем меняет версию сообщений, по ней манифест и сверяется'''
+    cached = cached_segments(room_id, messages_version)
+    if cached is not None:
+        return cached
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT first_id, last_id, object_key, codec
+            FROM darkhaven_message_segments
+            WHERE room_id = %s
+            ORDER BY last_id DESC
+        ''', (room_id,))
+        segments = cur.fetchall()
+    
+    with _archive_manifests_lock:
+        _archive_manifests[room_id] = (messages_version, segments)
+        _archive_manifests.move_to_end(room_id)
+        if len(_archive_manifests) > MAX_BUFFERED_ROOMS:
+            _archive_manifests.popitem(last=False)
+    return segments
+
+def cached_segments(room_id: str, messages_version: int):
+    '''Манифест из памяти без обращения к БД; None, если его ещё нужно прочитать'''
+    with _archive_manifests_lock:
+        cached = _archive_manifests.get(room_id)
+    return cached[1] if cached is not None and cached[0] == messages_version else None
+
+def with_archived_page(room_id: str, messages_version: int, messages: list, users: dict, before_id, limit: int):
+    archived, archived_users = fetch_archived_page(
+        room_id, messages_version, messages[0]['id'] if messages else before_id, limit - len(messages)
+    )
+    if not archived:
+        return messages, users
+    return archived + messages, {**archived_users, **users}
+
+def fetch_archived_page(room_id: str, messages_version: int, before_id, limit: int):
+    segments = archived_segments(room_id, messages_version)
+    if not segments:
+        return [], {}
+    
+    s3 = get_s3_client()
+    selected = []
+    for first_id, last_id, key, codec in segments:
+        if before_id is not None and first_id >= before_id:
+            continue
+        older = [m for m in segment_cache.get(s3, key, codec) if before_id is None or m['id'] < before_id]
+        selected = older[-(limit - len(selected)):] + selected
+        if len(selected) >= limit:
+            break
+    
+    if not selected:
+        return [], {}
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        users = fetch_authors(cur, {m['userId'] for m in selected})
+    return [m for m in selected if m['userId'] in users], users
+
+_partitions_checked_at = float('-inf')
+
+def message_partitions_due() -> bool:
+    return time.monotonic() - _partitions_checked_at >= PARTITION_CHECK_INTERVAL
+
+def ensure_message_partitions(conn):
+    '''Месячные секции сообщений создаются заранее, проверка раз в несколько часов
+
+    Вызывается до вставки: после долгой тишины первое сообщение иначе попало бы в
+    DEFAULT. Строки, которые всё же туда попали, функция в БД переносит в их секцию.
+    '''
+    import psycopg2
+    global _partitions_checked_at
+    
+    if not message_partitions_due():
+        return
+    _partitions_checked_at = time.monotonic()
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                SELECT CASE WHEN pg_try_advisory_xact_lock(%s)
+                            THEN darkhaven_create_message_partitions(%s) END
+            ''', (PARTITION_LOCK, PARTITION_MONTHS_AHEAD))
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        log_event('messagePartitions', {'error': str(e)})
+
+@instrumented('chat')
 def handler(event: dict, context) -> dict:
     '''Система чата с профилями пользователей'''
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return preflight_response(PREFLIGHT_HEADERS)
     
     try:
         if method == 'GET':
@@ -32,192 +429,338 @@ def handler(event: dict, context) -> dict:
     except Exception as e:
         return error_response(str(e), 500)
 
-def get_user_from_token(token: str):
-    import psycopg2
-    
+def get_user_from_token(cur, token: str):
     if not token:
         return None
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     
-    try:
-        cur.execute('''
-            SELECT id, username, avatar_url, is_admin, level, online_status
-            FROM darkhaven_users WHERE token = %s
-        ''', (token,))
-        
-        user = cur.fetchone()
-        if user:
-            return {
-                'id': user[0],
-                'username': user[1],
-                'avatarUrl': user[2],
-                'isAdmin': user[3],
-                'level': user[4],
-                'onlineStatus': user[5]
-            }
-        return None
-        
-    finally:
-        cur.close()
-        conn.close()
+    cur.execute('''
+        SELECT id, username, avatar_url, is_admin, level, online_status
+        FROM darkhaven_users WHERE token = %s
+    ''', (token,))
+    
+    user = cur.fetchone()
+    if user:
+        user = author_from_row(user)
+        token_cache.put(token, user)
+        return user
+    return None
 
-def get_messages(event: dict) -> dict:
-    import psycopg2
+LATEST_ID_SQL = 'SELECT COALESCE(MAX(id), 0) FROM darkhaven_messages WHERE room_id = %s'
+
+CHAT_VERSION_SQL = '''
+    SELECT (SELECT COALESCE(MAX(id), 0) FROM darkhaven_messages WHERE room_id = %s),
+           (SELECT version FROM darkhaven_versions WHERE name = 'messages'),
+           (SELECT version FROM darkhaven_versions WHERE name = 'users')
+'''
+
+AUTHORS_SQL = '''
+    SELECT id, username, avatar_url, is_admin, level, online_status
+    FROM darkhaven_users WHERE id = ANY(%s)
+'''
+
+MESSAGES_PAGE_SQL = '''
+    SELECT m.id, m.user_id, m.message, m.created_at, m.edited
+    FROM darkhaven_messages m
+    WHERE m.room_id = %s {condition}
+    ORDER BY m.id {order}
+    LIMIT %s
+'''
+
+def author_from_row(row) -> dict:
+    return {
+        'id': row[0],
+        'username': row[1],
+        'avatarUrl': row[2],
+        'isAdmin': row[3],
+        'level': row[4],
+        'onlineStatus': row[5]
+    }
+
+def messages_from_rows(rows, users: dict, order: str) -> list:
+    messages = []
+    for row in rows:
+        if row[1] not in users:
+            continue
+        messages.append({
+            'id': row[0],
+            'userId': row[1],
+            'message': row[2],
+            'timestamp': row[3],
+            'edited': row[4]
+        })
     
-    params = event.get('queryStringParameters') or {}
-    limit = int(params.get('limit', 50))
+    if order == 'DESC':
+        messages.reverse()
+    return messages
+
+def read_chat_version(cur, room_id: str) -> tuple:
+    cur.execute(CHAT_VERSION_SQL, (room_id,))
+    return tuple(cur.fetchone())
+
+def fetch_authors(cur, user_ids) -> dict:
+    cur.execute(AUTHORS_SQL, (list(user_ids),))
+    return {row[0]: author_from_row(row) for row in cur.fetchall()}
+
+def fetch_messages_page(cur, room_id: str, condition: str, order: str, args: tuple):
+    cur.execute(MESSAGES_PAGE_SQL.format(condition=condition, order=order), (room_id, *args))
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    rows = cur.fetchall()
+    users = fetch_authors(cur, {row[1] for row in rows}) if rows else {}
+    return messages_from_rows(rows, users, order), users
+
+def get_room_id(room_id) -> str:
+    if room_id is None or room_id == '':
+        return DEFAULT_ROOM
+    if not isinstance(room_id, str) or len(room_id) > MAX_ROOM_ID_LENGTH:
+        return None
+    return room_id
+
+def parse_wait(value) -> float:
+    '''nan и inf проходят через min/max, а nan ещё и истинно — отвергаем их явно'''
+    wait = float(value or 0)
+    if not math.isfinite(wait):
+        raise ValueError('wait must be a finite number')
+    return min(max(wait, 0), MAX_WAIT_SECONDS)
+
+def read_fetch_request(event: dict) -> tuple:
+    '''(ответ с ошибкой или None, комната, limit, since_id, before_id, wait)'''
+    params = get_query_params(event)
+    room_id = get_room_id(params.get('room_id'))
+    
+    if room_id is None:
+        return error_response('Invalid room_id', 400), None, None, None, None, None
     
     try:
-        cur.execute('''
-            SELECT m.id, m.message, m.created_at, m.edited,
-                   u.id, u.username, u.avatar_url, u.is_admin, u.level, u.online_status
-            FROM darkhaven_messages m
-            JOIN darkhaven_users u ON m.user_id = u.id
-            ORDER BY m.created_at DESC
-            LIMIT %s
-        ''', (limit,))
-        
-        messages = []
-        for row in cur.fetchall():
-            messages.append({
-                'id': row[0],
-                'message': row[1],
-                'timestamp': row[2].isoformat(),
-                'edited': row[3],
-                'user': {
-                    'id': row[4],
-                    'username': row[5],
-                    'avatarUrl': row[6],
-                    'isAdmin': row[7],
-                    'level': row[8],
-                    'onlineStatus': row[9]
-                }
-            })
-        
-        messages.reverse()
-        return success_response({'messages': messages})
-        
-    finally:
-        cur.close()
-        conn.close()
+        limit = min(max(int(params.get('limit', 50)), 1), MAX_MESSAGES_LIMIT)
+        since_id = int(params['since_id']) if params.get('since_id') else None
+        before_id = int(params['before_id']) if params.get('before_id') else None
+        wait = parse_wait(params.get('wait'))
+    except ValueError:
+        return error_response('Invalid pagination parameters', 400), None, None, None, None, None
+    
+    if since_id is not None and before_id is not None:
+        return error_response('Use either since_id or before_id', 400), None, None, None, None, None
+    
+    return None, room_id, limit, since_id, before_id, wait
 
-def send_message(event: dict) -> dict:
-    import psycopg2
+def chat_etag(version: tuple) -> str:
+    max_id, messages_version, users_version = version
+    return f'W/"{max_id}.{messages_version}.{users_version}"'
+
+def unchanged_response(event: dict, version: tuple, since_id):
+    '''304 или 204 без чтения страницы, если клиенту нечего отдавать'''
+    etag = chat_etag(version)
     
-    token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
-    user = get_user_from_token(token)
+    if etag_matches(event, etag):
+        return not_modified_response(etag)
     
-    if not user:
-        return error_response('Unauthorized', 401)
+    if since_id is not None and since_id >= version[0]:
+        return no_content_response()
+    
+    return None
+
+def page_query(limit: int, since_id, before_id) -> tuple:
+    if since_id is not None:
+        return 'AND m.id > %s', 'ASC', (since_id, limit)
+    if before_id is not None:
+        return 'AND m.id < %s', 'DESC', (before_id, limit)
+    return '', 'DESC', (limit,)
+
+def needs_archive(messages: list, limit: int, since_id) -> bool:
+    return since_id is None and len(messages) < limit
+
+def messages_response(room_id: str, version: tuple, messages: list, users: dict, since_id) -> dict:
+    if since_id is not None and not messages:
+        return no_content_response()
+    
+    return success_response({'roomId': room_id, 'messages': messages, 'users': users},
+                            etag_headers(chat_etag(version)))
+
+def get_messages(event: dict) -> dict:
+    error, room_id, limit, since_id, before_id, wait = read_fetch_request(event)
+    if error is not None:
+        return error
+    
+    if not room_exists(room_id):
+        return error_response('Room not found', 404)
+    
+    if wait and since_id is not None and message_listener.ensure_listening():
+        notified_id = message_listener.latest_id(room_id)
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(LATEST_ID_SQL, (room_id,))
+            latest_id = cur.fetchone()[0]
+        
+        if latest_id <= since_id:
+            # notified_id выше since_id, только если новейшее сообщение удалили:
+            # ждём следующего за ним, иначе опрос вернулся бы сразу
+            message_listener.wait_for(room_id, max(since_id, notified_id), wait)
+    
+    recent_messages = recent_messages_for(room_id)
+    version = recent_messages.fresh_version()
+    if version is None:
+        with db_connection() as conn, conn.cursor() as cur:
+            version = recent_messages.sync(cur)
+    
+    unchanged = unchanged_response(event, version, since_id)
+    if unchanged is not None:
+        return unchanged
+    
+    page = recent_messages.page(limit, since_id, before_id)
+    
+    if page is None:
+        condition, order, args = page_query(limit, since_id, before_id)
+        with db_connection() as conn, conn.cursor() as cur:
+            page = fetch_messages_page(cur, room_id, condition, order, args)
+    
+    messages, users = page
+    
+    if needs_archive(messages, limit, since_id):
+        messages, users = with_archived_page(room_id, version[1], messages, users, before_id, limit)
+    
+    return messages_response(room_id, version, messages, users, since_id)
+
+SEND_MESSAGE_SQL = '''
+    WITH author AS (
+        SELECT id, username, avatar_url, is_admin, level, online_status
+        FROM darkhaven_users WHERE token = %s
+    ), inserted AS (
+        INSERT INTO darkhaven_messages (room_id, user_id, message, created_at)
+        SELECT %s, id, %s, CURRENT_TIMESTAMP FROM author
+        RETURNING id, user_id, message, created_at, edited
+    ), counters AS (
+        INSERT INTO darkhaven_user_counter_deltas (user_id, messages, experience)
+        SELECT user_id, 1, %s FROM inserted
+    )
+    SELECT i.id, i.message, i.created_at, i.edited,
+           a.id, a.username, a.avatar_url, a.is_admin, a.level, a.online_status,
+           pg_notify(%s, i.id::text || ':' || %s)
+    FROM inserted i JOIN author a ON a.id = i.user_id
+'''
+
+def read_send_request(event: dict) -> tuple:
+    '''(ответ с ошибкой или None, токен, текст, комната) — общая проверка для handler и server'''
+    token = get_token(event)
+    
+    if not token:
+        return error_response('Unauthorized', 401), None, None, None
     
-    body = json.loads(event.get('body', '{}'))
+    body = parse_body(event)
     message = body.get('message', '').strip()
     
     if not message:
-        return error_response('Message cannot be empty', 400)
+        return error_response('Message cannot be empty', 400), None, None, None
     
     if len(message) > 1000:
-        return error_response('Message too long', 400)
+        return error_response('Message too long', 400), None, None, None
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    room_id = get_room_id(body.get('roomId'))
     
-    try:
-        cur.execute('''
-            INSERT INTO darkhaven_messages (user_id, message, created_at)
-            VALUES (%s, %s, CURRENT_TIMESTAMP)
-            RETURNING id, message, created_at, edited
-        ''', (user['id'], message))
+    if room_id is None:
+        return error_response('Invalid roomId', 400), None, None, None
+    
+    return None, token, message, room_id
+
+def check_send_limits(event: dict, token: str):
+    retry_after = send_ip_limiter.check(client_key(event))
+    if retry_after is None:
+        retry_after = send_limiter.check(client_key(event, token))
+    return retry_after
+
+def send_message_args(token: str, message: str, room_id: str) -> tuple:
+    return token, room_id, message, EXPERIENCE_PER_MESSAGE, MESSAGES_CHANNEL, room_id
+
+def sent_message_response(row, room_id: str) -> dict:
+    user = author_from_row(row[4:10])
+    sent = {
+        'id': row[0],
+        'userId': row[4],
+        'message': row[1],
+        'timestamp': row[2],
+        'edited': row[3]
+    }
+    known_rooms.add(room_id)
+    recent_messages_for(room_id).append(sent, user)
+    
+    return success_response({'message': {**sent, 'roomId': room_id, 'user': user}})
+
+def send_message(event: dict) -> dict:
+    token = get_token(event)
+    
+    if not token:
+        return error_response('Unauthorized', 401)
+    
+    retry_after = check_send_limits(event, token)
+    if retry_after is not None:
+        return too_many_requests_response(retry_after)
+    
+    error, token, message, room_id = read_send_request(event)
+    if error is not None:
+        return error
+    
+    import psycopg2
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        ensure_message_partitions(conn)
         
-        msg = cur.fetchone()
+        try:
+            cur.execute(SEND_MESSAGE_SQL, send_message_args(token, message, room_id))
+        except psycopg2.errors.ForeignKeyViolation:
+            conn.rollback()
+            return error_response('Room not found', 404)
         
-        cur.execute('''
-            UPDATE darkhaven_users 
-            SET total_messages = total_messages + 1, 
-                experience = experience + 10
-            WHERE id = %s
-        ''', (user['id'],))
+        row = cur.fetchone()
         
-        conn.commit()
+        if not row:
+            conn.rollback()
+            return error_response('Unauthorized', 401)
         
-        return success_response({
-            'message': {
-                'id': msg[0],
-                'message': msg[1],
-                'timestamp': msg[2].isoformat(),
-                'edited': msg[3],
-                'user': user
-            }
-        })
+        conn.commit()
         
-    finally:
-        cur.close()
-        conn.close()
+        if counter_folder.due():
+            counter_folder.fold(conn)
+    
+    return sent_message_response(row, room_id)
 
 def delete_message(event: dict) -> dict:
-    import psycopg2
+    token = get_token(event)
     
-    token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
-    user = get_user_from_token(token)
-    
-    if not user:
+    if not token:
         return error_response('Unauthorized', 401)
     
-    params = event.get('queryStringParameters') or {}
+    params = get_query_params(event)
     message_id = params.get('id')
     
-    if not message_id:
-        return error_response('Message ID required', 400)
-    
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    try:
-        cur.execute('SELECT user_id FROM darkhaven_messages WHERE id = %s', (message_id,))
-        msg = cur.fetchone()
+    with db_connection() as conn, conn.cursor() as cur:
+        user = get_user_from_token(cur, token)
         
-        if not msg:
-            return error_response('Message not found', 404)
+        if not user:
+            return error_response('Unauthorized', 401)
         
-        if msg[0] != user['id'] and not user['isAdmin']:
-            return error_response('Forbidden', 403)
+        if not message_id:
+            return error_response('Message ID required', 400)
         
-        cur.execute('DELETE FROM darkhaven_messages WHERE id = %s', (message_id,))
-        conn.commit()
+        cur.execute('''
+            DELETE FROM darkhaven_messages
+            WHERE id = %s AND (user_id = %s OR %s)
+            RETURNING room_id
+        ''', (message_id, user['id'], user['isAdmin']))
         
-        return success_response({'message': 'Message deleted'})
+        deleted = cur.fetchone()
         
-    finally:
-        cur.close()
-        conn.close()
-
-def success_response(data: dict) -> dict:
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps(data),
-        'isBase64Encoded': False
-    }
-
-def error_response(message: str, status_code: int) -> dict:
-    return {
-        'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({'error': message}),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+        if deleted:
+            cur.execute("SELECT version FROM darkhaven_versions WHERE name = 'messages'")
+            messages_version = cur.fetchone()[0]
+            conn.commit()
+            recent_messages_for(deleted[0]).remove(int(message_id), messages_version)
+            return success_response({'message': 'Message deleted'})
+        
+        cur.execute('SELECT 1 FROM darkhaven_messages WHERE id = %s', (message_id,))
+        
+        if not cur.fetchone():
+            return error_response('Message not found', 404)
+        
+        return error_response('Forbidden', 403)
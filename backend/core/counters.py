@@ -0,0 +1,66 @@
+'''Отложенные счётчики пользователей: сообщения и опыт'''
+import os
+import threading
+import time
+
+from core.timing import elapsed_ms, log_event
+
+COUNTER_FOLD_INTERVAL = float(os.environ.get('COUNTER_FOLD_INTERVAL', '30'))
+COUNTER_FOLD_LOCK = 0x6468_0001
+EXPERIENCE_PER_MESSAGE = 10
+EXPERIENCE_PER_LEVEL = 100
+
+class CounterFolder:
+    '''Сворачивает накопленные приросты в darkhaven_users не чаще раза в интервал
+
+    Строки приростов удаляются и применяются одним запросом, поэтому
+    параллельные свёртки из разных экземпляров не посчитают их дважды,
+    а advisory-блокировка не даёт им толкаться на одних и тех же строках.
+    '''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._folded_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def due(self) -> bool:
+        return time.monotonic() - self._folded_at >= self.interval
+
+    def fold(self, conn):
+        import psycopg2
+
+        if not self._lock.acquire(blocking=False):
+            return
+
+        started = time.perf_counter()
+        self._folded_at = time.monotonic()
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (COUNTER_FOLD_LOCK,))
+                if not cur.fetchone()[0]:
+                    conn.rollback()
+                    return
+
+                cur.execute('''
+                    WITH folded AS (
+                        DELETE FROM darkhaven_user_counter_deltas
+                        RETURNING user_id, messages, experience
+                    ), totals AS (
+                        SELECT user_id, SUM(messages) AS messages, SUM(experience) AS experience
+                        FROM folded GROUP BY user_id
+                    )
+                    UPDATE darkhaven_users u
+                    SET total_messages = u.total_messages + t.messages,
+                        experience = u.experience + t.experience,
+                        level = (u.experience + t.experience) / %s + 1
+                    FROM totals t WHERE u.id = t.user_id
+                ''', (EXPERIENCE_PER_LEVEL,))
+                users = cur.rowcount
+            conn.commit()
+            log_event('counterFold', {'users': users, 'totalMs': elapsed_ms(started)})
+        except psycopg2.Error as e:
+            conn.rollback()
+            log_event('counterFold', {'error': str(e)})
+        finally:
+            self._lock.release()
@@ -0,0 +1 @@
+'''Необязательный единый asyncio-сервер для самостоятельного развёртывания'''
@@ -0,0 +1,21 @@
+'''Запуск из каталога backend: python -m server --port 8080
+
+Маршруты: /auth, /chat, /users, /upload — тот же контракт, что у облачных функций.
+'''
+import argparse
+import os
+
+from server.app import create_app
+
+def main():
+    from aiohttp import web
+    
+    parser = argparse.ArgumentParser(description='Dark Haven backend in one asyncio process')
+    parser.add_argument('--host', default=os.environ.get('SERVER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVER_PORT', '8080')))
+    args = parser.parse_args()
+    
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+'''Один asyncio-процесс для auth, chat, users и upload
+
+Каждый запрос превращается в событие облачной функции, ответ — обратно в
+HTTP. Чат (GET и POST /chat) работает прямо в цикле событий на asyncpg
+(server.chat): опросы, 304 и long-poll не занимают потоков. Остальные
+обработчики — auth, users, upload и удаление сообщений — выполняются как
+есть в пуле потоков поверх того же пула asyncpg (server.pgbridge) и общего
+клиента S3 (core.storage).
+'''
+import asyncio
+import base64
+import importlib.util
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from core import db
+from server.chat import AsyncChat
+from server.pgbridge import AsyncpgBridge
+
+FUNCTIONS = ('auth', 'chat', 'users', 'upload')
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '32'))
+SERVER_DB_POOL_MAX = int(os.environ.get('SERVER_DB_POOL_MAX', '20'))
+SERVER_MAX_BODY = int(os.environ.get('SERVER_MAX_BODY', str(64 * 1024 * 1024)))
+# Число доверенных обратных прокси перед сервером. За прокси request.remote — его
+# адрес, и лимиты по IP стали бы общими на весь сайт; с SERVER_TRUSTED_PROXY=1 адрес
+# клиента берётся из X-Forwarded-For (N-й адрес справа) или X-Real-IP. Без прокси
+# оставьте 0: клиент сам может прислать эти заголовки
+SERVER_TRUSTED_PROXY = int(os.environ.get('SERVER_TRUSTED_PROXY', '0'))
+LISTEN_RECONNECT_DELAY = 1
+
+def load_function(name: str):
+    path = os.path.join(BACKEND_DIR, name, 'index.py')
+    spec = importlib.util.spec_from_file_location(f'{name}_index', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class ChatNotifications:
+    '''LISTEN на отдельном соединении asyncpg будит ожидающие опросы и ring buffer чата'''
+    
+    def __init__(self, chat):
+        self.chat = chat
+        self.ready = False
+        self.session = 0
+        self._events = {}
+        self._task = None
+    
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def wait_for(self, room_id: str, since_id: int, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.chat.message_listener.latest_id(room_id) <= since_id:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            event = self._events.setdefault(room_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+    
+    def _notify(self, connection, pid, channel, payload):
+        message_id, _, room_id = payload.partition(':')
+        if not message_id.isdigit():
+            return
+        self.chat.message_listener.publish({room_id: int(message_id)})
+        event = self._events.pop(room_id, None)
+        if event is not None:
+            event.set()
+    
+    async def _run(self):
+        import asyncpg
+        
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(db.get_dsn())
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _: closed.set())
+                await conn.add_listener(self.chat.MESSAGES_CHANNEL, self._notify)
+                self.session += 1
+                self.ready = True
+                await closed.wait()
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                pass
+            finally:
+                self.ready = False
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(LISTEN_RECONNECT_DELAY)
+
+def client_address(request) -> str:
+    if SERVER_TRUSTED_PROXY > 0:
+        forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+        if forwarded:
+            # Правые адреса дописали наши прокси; если их меньше N, самый левый — клиент
+            return forwarded[-min(SERVER_TRUSTED_PROXY, len(forwarded))]
+        real_ip = request.headers.get('X-Real-IP', '').strip()
+        if real_ip:
+            return real_ip
+    return request.remote
+
+def build_event(request, body: str) -> dict:
+    return {
+        'httpMethod': request.method,
+        'path': request.path,
+        'headers': dict(request.headers),
+        'queryStringParameters': dict(request.query),
+        'body': body,
+        'isBase64Encoded': False,
+        'requestContext': {'identity': {'sourceIp': client_address(request)}}
+    }
+
+def build_response(result: dict):
+    from aiohttp import web
+    
+    body = result.get('body') or ''
+    body = base64.b64decode(body) if result.get('isBase64Encoded') else body.encode()
+    return web.Response(status=result['statusCode'], headers=result.get('headers') or {}, body=body)
+
+async def run_handler(app, module, event: dict) -> dict:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app['executor'], module.handler, event, None)
+
+async def dispatch(request):
+    from aiohttp import web
+    
+    app = request.app
+    module = app['functions'].get(request.match_info['function'])
+    if module is None:
+        raise web.HTTPNotFound()
+    
+    event = build_event(request, await request.text())
+    
+    if request.method == 'OPTIONS':
+        result = module.handler(event, None)
+    elif module is app['functions']['chat'] and request.method in ('GET', 'POST'):
+        result = await app['chat'].handle(event)
+    else:
+        result = await run_handler(app, module, event)
+    return build_response(result)
+
+async def on_startup(app):
+    import asyncpg
+    
+    app['pool'] = await asyncpg.create_pool(db.get_dsn(), min_size=db.DB_POOL_MIN, max_size=SERVER_DB_POOL_MAX)
+    db.use_connection_provider(AsyncpgBridge(app['pool'], asyncio.get_running_loop()).connection)
+    app['notifications'] = ChatNotifications(app['functions']['chat'])
+    app['notifications'].start()
+    app['chat'] = AsyncChat(app['functions']['chat'], app['pool'], app['executor'], app['notifications'])
+
+async def on_cleanup(app):
+    await app['notifications'].stop()
+    app['executor'].shutdown(wait=False, cancel_futures=True)
+    await app['pool'].close()
+
+def create_app():
+    from aiohttp import web
+    
+    app = web.Application(client_max_size=SERVER_MAX_BODY)
+    app['functions'] = {name: load_function(name) for name in FUNCTIONS}
+    app['executor'] = ThreadPoolExecutor(max_workers=SERVER_WORKERS, thread_name_prefix='handler')
+    app.router.add_route('*', '/{function}', dispatch)
+    app.router.add_route('*', '/{function}/{tail:.*}', dispatch)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
@@ -0,0 +1,198 @@
+'''Чат на asyncpg: опрос и отправка сообщений прямо в цикле событий
+
+GET и POST /chat не занимают ни поток, ни соединение на время ожидания:
+запросы к БД идут через общий пул asyncpg, ring buffer и ETag берутся из
+модуля chat, а SQL и сборка ответов — общие с облачной функцией. Пока LISTEN
+не прерывался, последний id комнаты известен из уведомлений, и опрос без
+новых сообщений не обращается к БД вовсе. В пул потоков уходят только
+редкие синхронные шаги: архив в S3, свёртка счётчиков, проверка секций и
+общий лимит RATE_LIMIT_BACKEND=postgres.
+'''
+import asyncio
+
+from core import db
+from core.ratelimit import RATE_LIMIT_BACKEND
+from core.request import get_token
+from core.responses import error_response, too_many_requests_response
+from core.timing import log_event
+from server.pgbridge import to_asyncpg_query
+
+class AsyncChat:
+    def __init__(self, chat, pool, executor, notifications):
+        self.chat = chat
+        self.pool = pool
+        self.executor = executor
+        self.notifications = notifications
+        self.latest_id_sql = to_asyncpg_query(chat.LATEST_ID_SQL)
+        self.version_sql = to_asyncpg_query(chat.CHAT_VERSION_SQL)
+        self.authors_sql = to_asyncpg_query(chat.AUTHORS_SQL)
+        self.send_sql = to_asyncpg_query(chat.SEND_MESSAGE_SQL)
+        self.room_ids_sql = to_asyncpg_query(chat.ROOM_IDS_SQL)
+        self._page_sql = {}
+        self._sync_locks = {}
+        self._seeded_rooms = {}
+        self._maintaining = False
+    
+    async def run_sync(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+    
+    async def fetch_authors(self, conn, user_ids) -> dict:
+        rows = await conn.fetch(self.authors_sql, list(user_ids))
+        return {row[0]: self.chat.author_from_row(row) for row in rows}
+    
+    async def fetch_messages_page(self, conn, room_id: str, condition: str, order: str, args: tuple):
+        query = self._page_sql.get((condition, order))
+        if query is None:
+            query = self._page_sql[(condition, order)] = to_asyncpg_query(
+                self.chat.MESSAGES_PAGE_SQL.format(condition=condition, order=order)
+            )
+        
+        rows = await conn.fetch(query, room_id, *args)
+        users = await self.fetch_authors(conn, {row[1] for row in rows}) if rows else {}
+        return self.chat.messages_from_rows(rows, users, order), users
+    
+    async def sync(self, buffer) -> tuple:
+        '''(версия, можно ли отдавать страницу из буфера); одна синхронизация на комнату за раз'''
+        lock = self._sync_locks.setdefault(buffer.room_id, asyncio.Lock())
+        async with lock:
+            version = buffer.fresh_version()
+            if version is not None:
+                return version, True
+            
+            notified_id = self.chat.message_listener.latest_id(buffer.room_id)
+            async with self.pool.acquire() as conn:
+                version = tuple(await conn.fetchrow(self.version_sql, buffer.room_id))
+                plan = buffer.plan_sync(version)
+                replace, since_id, author_ids = plan
+                page = authors = None
+                if since_id is not None:
+                    page = await self.fetch_messages_page(conn, buffer.room_id, 'AND m.id > %s', 'ASC',
+                                                          (since_id, buffer.capacity + 1))
+                    if len(page[0]) > buffer.capacity:
+                        replace, page = True, None
+                if replace:
+                    page = await self.fetch_messages_page(conn, buffer.room_id, '', 'DESC', (buffer.capacity,))
+                elif author_ids:
+                    authors = await self.fetch_authors(conn, author_ids)
+            
+            synced = buffer.apply_sync(version, plan, replace, page, authors, notified_id)
+            return (synced, True) if synced is not None else (version, False)
+    
+    async def wait_for_messages(self, room_id: str, since_id: int, wait: float):
+        '''Из БД последний id читается один раз на комнату за сессию LISTEN, дальше его ведут уведомления
+
+        Уведомления только поднимают id. Если он выше since_id, новейшее сообщение
+        могли удалить, поэтому это сверяется с БД, а ждать нужно id выше известного.
+        '''
+        listener = self.chat.message_listener
+        notified_id = listener.latest_id(room_id)
+        session = self.notifications.session
+        if notified_id > since_id or self._seeded_rooms.get(room_id) != session:
+            latest_id = await self.pool.fetchval(self.latest_id_sql, room_id)
+            listener.publish({room_id: latest_id})
+            self._seeded_rooms[room_id] = session
+            if latest_id > since_id:
+                return
+        
+        await self.notifications.wait_for(room_id, max(since_id, notified_id), wait)
+    
+    async def get_messages(self, event: dict) -> dict:
+        chat = self.chat
+        error, room_id, limit, since_id, before_id, wait = chat.read_fetch_request(event)
+        if error is not None:
+            return error
+        
+        if chat.known_rooms.stale():
+            chat.known_rooms.load(row[0] for row in await self.pool.fetch(self.room_ids_sql))
+        if room_id not in chat.known_rooms:
+            return error_response('Room not found', 404)
+        
+        if wait and since_id is not None and self.notifications.ready:
+            await self.wait_for_messages(room_id, since_id, wait)
+        
+        buffer = chat.recent_messages_for(room_id)
+        version, buffered = buffer.fresh_version(), True
+        if version is None:
+            version, buffered = await self.sync(buffer)
+        
+        unchanged = chat.unchanged_response(event, version, since_id)
+        if unchanged is not None:
+            return unchanged
+        
+        page = buffer.page(limit, since_id, before_id) if buffered else None
+        
+        if page is None:
+            condition, order, args = chat.page_query(limit, since_id, before_id)
+            async with self.pool.acquire() as conn:
+                page = await self.fetch_messages_page(conn, room_id, condition, order, args)
+        
+        messages, users = page
+        
+        if chat.needs_archive(messages, limit, since_id) and chat.cached_segments(room_id, version[1]) != []:
+            messages, users = await self.run_sync(
+                chat.with_archived_page, room_id, version[1], messages, users, before_id, limit
+            )
+        
+        return chat.messages_response(room_id, version, messages, users, since_id)
+    
+    async def send_message(self, event: dict) -> dict:
+        import asyncpg
+        
+        chat = self.chat
+        token = get_token(event)
+        
+        if not token:
+            return error_response('Unauthorized', 401)
+        
+        if RATE_LIMIT_BACKEND == 'postgres':
+            retry_after = await self.run_sync(chat.check_send_limits, event, token)
+        else:
+            retry_after = chat.check_send_limits(event, token)
+        if retry_after is not None:
+            return too_many_requests_response(retry_after)
+        
+        error, token, message, room_id = chat.read_send_request(event)
+        if error is not None:
+            return error
+        
+        if chat.message_partitions_due():
+            await self.run_sync(self.ensure_partitions)
+        
+        try:
+            row = await self.pool.fetchrow(self.send_sql, *chat.send_message_args(token, message, room_id))
+        except asyncpg.ForeignKeyViolationError:
+            return error_response('Room not found', 404)
+        
+        if row is None:
+            return error_response('Unauthorized', 401)
+        
+        if not self._maintaining and chat.counter_folder.due():
+            self._maintaining = True
+            asyncio.get_running_loop().run_in_executor(self.executor, self.maintain)
+        
+        return chat.sent_message_response(row, room_id)
+    
+    def ensure_partitions(self):
+        '''Секции проверяются до вставки, как в облачной функции; раз в несколько часов'''
+        with db.db_connection() as conn:
+            self.chat.ensure_message_partitions(conn)
+    
+    def maintain(self):
+        '''Свёртка счётчиков — в потоке, через мост к пулу asyncpg'''
+        try:
+            with db.db_connection() as conn:
+                if self.chat.counter_folder.due():
+                    self.chat.counter_folder.fold(conn)
+        except Exception as e:
+            log_event('chatMaintenance', {'error': str(e)})
+        finally:
+            self._maintaining = False
+    
+    async def handle(self, event: dict) -> dict:
+        method = event.get('httpMethod', 'GET')
+        try:
+            if method == 'GET':
+                return await self.get_messages(event)
+            return await self.send_message(event)
+        except Exception as e:
+            return error_response(str(e), 500)
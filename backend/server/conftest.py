@@ -0,0 +1,99 @@
+'''Общие фикстуры тестов сервера: цикл событий в отдельном потоке и пул asyncpg
+
+Тесты идут против настоящего PostgreSQL и пропускаются без него:
+
+    SERVER_TEST_DATABASE_URL=postgresql://localhost/darkhaven_test \\
+        python -m pytest server
+
+База должна быть одноразовой, с применёнными db_migrations: тесты создают
+пользователей и сообщения и не убирают их за собой.
+'''
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+TEST_DSN = os.environ.get('SERVER_TEST_DATABASE_URL')
+
+class LoopThread:
+    '''Цикл событий сервера; тест обращается к нему из своего потока, как обработчики'''
+    
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+    
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(30)
+    
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+@pytest.fixture(scope='session')
+def dsn():
+    if not TEST_DSN:
+        pytest.skip('SERVER_TEST_DATABASE_URL is not set')
+    pytest.importorskip('asyncpg')
+    pytest.importorskip('psycopg2')
+    return TEST_DSN
+
+@pytest.fixture(scope='session')
+def loop_thread(dsn):
+    loop_thread = LoopThread()
+    yield loop_thread
+    loop_thread.stop()
+
+@pytest.fixture(scope='session')
+def pool(loop_thread, dsn):
+    import asyncpg
+    
+    async def create():
+        return await asyncpg.create_pool(dsn, min_size=1, max_size=5)
+    
+    pool = loop_thread.run(create())
+    yield pool
+    loop_thread.run(pool.close())
+
+@pytest.fixture(scope='session')
+def bridge(loop_thread, pool):
+    from server.pgbridge import AsyncpgBridge
+    
+    async def create():
+        return AsyncpgBridge(pool, asyncio.get_running_loop())
+    
+    return loop_thread.run(create())
+
+@pytest.fixture(scope='session')
+def executor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown()
+
+@pytest.fixture
+def bridged_db(bridge, dsn, monkeypatch):
+    '''Обработчики ходят в БД через мост, как под python -m server'''
+    from core import db
+    
+    monkeypatch.setenv('DATABASE_URL', dsn)
+    db.use_connection_provider(bridge.connection)
+    yield db
+    db.use_connection_provider(None)
+
+@pytest.fixture(scope='session')
+def functions(dsn):
+    os.environ.setdefault('DATABASE_URL', dsn)
+    from core.ratelimit import DEFAULT_RATE_LIMITS
+    for endpoint in DEFAULT_RATE_LIMITS:
+        os.environ.setdefault(f'RATE_LIMIT_{endpoint.upper()}', '0')
+    
+    from server.app import load_function
+    return {name: load_function(name) for name in ('auth', 'chat', 'users')}
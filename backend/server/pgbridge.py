@@ -0,0 +1,215 @@
+'''Интерфейс соединений psycopg2 поверх общего пула asyncpg
+
+Синхронные обработчики выполняются в потоках сервера и работают с БД как
+раньше: with db_connection() as conn, conn.cursor() as cur. Каждый вызов
+передаётся в цикл событий, где его выполняет соединение из пула asyncpg.
+Параметры %s переводятся в $n. psycopg2 подставлял значения литералами, а
+asyncpg требует точные типы, поэтому значения заранее приводятся к типам
+параметров запроса; типы и то, возвращает ли запрос строки, узнаются один
+раз на запрос. rowcount, как в psycopg2, — число строк для запросов с
+результатом и число затронутых строк из статуса команды для остальных.
+Ошибки asyncpg превращаются в исключения psycopg2 с тем же SQLSTATE, чтобы
+обработчики ловили их без изменений.
+'''
+import asyncio
+import itertools
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+
+from core import instrumentation
+
+_PLACEHOLDER = re.compile(r'%([s%])')
+_STATUS_ROWCOUNT = re.compile(r' (\d+)$')
+QUERY_INFO_CACHE_SIZE = 512
+
+def to_asyncpg_query(query: str) -> str:
+    numbers = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda m: f'${next(numbers)}' if m.group(1) == 's' else '%', query)
+
+def coerce(value, type_name: str):
+    '''Приводит значение так, как его понял бы PostgreSQL из литерала psycopg2'''
+    if value is None:
+        return None
+    if type_name.endswith('[]') and isinstance(value, (list, tuple)):
+        return [coerce(item, type_name[:-2]) for item in value]
+    if type_name in ('int2', 'int4', 'int8'):
+        if isinstance(value, float) and not value.is_integer():
+            raise ValueError(f'{value!r} is not a valid {type_name}')
+        return int(value)
+    if type_name in ('float4', 'float8'):
+        return float(value)
+    if type_name == 'numeric':
+        return value if isinstance(value, Decimal) else Decimal(str(value))
+    if type_name in ('text', 'varchar', 'bpchar', 'name') and not isinstance(value, str):
+        return str(value)
+    if type_name == 'bool' and isinstance(value, str):
+        return value.lower() in ('t', 'true', '1', 'yes', 'on')
+    if type_name in ('timestamp', 'timestamptz') and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if type_name == 'date' and isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+def status_rowcount(status: str) -> int:
+    '''"UPDATE 3" -> 3, "INSERT 0 1" -> 1; -1 для команд без счётчика'''
+    match = _STATUS_ROWCOUNT.search(status or '')
+    return int(match.group(1)) if match else -1
+
+def translate_error(error: Exception) -> Exception:
+    import asyncpg
+    import psycopg2
+    import psycopg2.errors
+    
+    if isinstance(error, asyncpg.PostgresError) and getattr(error, 'sqlstate', None):
+        try:
+            return psycopg2.errors.lookup(error.sqlstate)(str(error))
+        except KeyError:
+            return psycopg2.DatabaseError(str(error))
+    if isinstance(error, ValueError):
+        return psycopg2.DataError(str(error))
+    if isinstance(error, (asyncpg.InterfaceError, ConnectionError, OSError)):
+        return psycopg2.OperationalError(str(error))
+    return error
+
+class BridgeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self._rows = []
+        self._position = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            self._rows, self.rowcount = self.connection.run(self.connection.execute(query, vars))
+            self._position = 0
+        finally:
+            if instrumentation.ENABLED:
+                instrumentation.record_sql(started)
+    
+    def executemany(self, query, vars_list):
+        rowcount = 0
+        for vars in vars_list:
+            self.execute(query, vars)
+            rowcount += max(self.rowcount, 0)
+        self.rowcount = rowcount
+    
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        row = self._rows[self._position]
+        self._position += 1
+        return row
+    
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+    
+    def close(self):
+        self._rows = []
+
+class BridgeConnection:
+    '''Транзакция открывается первым запросом и закрывается commit/rollback, как в psycopg2'''
+    
+    def __init__(self, bridge, raw):
+        self.bridge = bridge
+        self.raw = raw
+        self.autocommit = False
+        self.closed = 0
+        self._transaction = None
+    
+    def run(self, coro):
+        import psycopg2
+        
+        try:
+            return self.bridge.run(coro)
+        except Exception as e:
+            translated = translate_error(e)
+            if translated is e:
+                raise
+            if isinstance(translated, psycopg2.OperationalError):
+                self.closed = 2
+            raise translated from e
+    
+    def cursor(self):
+        return BridgeCursor(self)
+    
+    async def execute(self, query: str, vars):
+        if self._transaction is None and not self.autocommit:
+            self._transaction = self.raw.transaction()
+            await self._transaction.start()
+        
+        if vars is not None:
+            query = to_asyncpg_query(query)
+        type_names, returns_rows = await self.bridge.query_info(self.raw, query)
+        args = [coerce(value, type_name) for value, type_name in zip(vars or (), type_names)]
+        
+        if returns_rows:
+            rows = [tuple(row) for row in await self.raw.fetch(query, *args)]
+            return rows, len(rows)
+        return [], status_rowcount(await self.raw.execute(query, *args))
+    
+    async def _finish(self, commit: bool):
+        transaction, self._transaction = self._transaction, None
+        if transaction is not None:
+            await (transaction.commit() if commit else transaction.rollback())
+    
+    def commit(self):
+        self.run(self._finish(True))
+    
+    def rollback(self):
+        self.run(self._finish(False))
+
+class AsyncpgBridge:
+    def __init__(self, pool, loop):
+        self.pool = pool
+        self.loop = loop
+        self._loop_thread = threading.get_ident()
+        self._query_info = OrderedDict()
+    
+    async def query_info(self, raw, query: str) -> tuple:
+        '''Типы параметров и наличие результата; prepare выполняется один раз на текст запроса'''
+        info = self._query_info.get(query)
+        if info is None:
+            statement = await raw.prepare(query)
+            info = ([param.name for param in statement.get_parameters()], bool(statement.get_attributes()))
+            self._query_info[query] = info
+            if len(self._query_info) > QUERY_INFO_CACHE_SIZE:
+                self._query_info.popitem(last=False)
+        else:
+            self._query_info.move_to_end(query)
+        return info
+    
+    def run(self, coro):
+        if threading.get_ident() == self._loop_thread:
+            coro.close()
+            raise RuntimeError('Synchronous database access from the event loop thread')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    
+    async def _acquire(self):
+        return await self.pool.acquire()
+    
+    @contextmanager
+    def connection(self):
+        raw = self.run(self._acquire())
+        conn = BridgeConnection(self, raw)
+        try:
+            yield conn
+        finally:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            finally:
+                self.run(self.pool.release(raw))
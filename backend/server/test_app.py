@@ -0,0 +1,30 @@
+'''Адрес клиента за обратным прокси: от него зависят лимиты по IP'''
+from types import SimpleNamespace
+
+import pytest
+
+from server import app
+
+def request(remote='10.0.0.2', **headers):
+    return SimpleNamespace(remote=remote, headers={key.replace('_', '-'): value for key, value in headers.items()})
+
+@pytest.mark.parametrize('trusted, req, expected', [
+    (0, request(X_Forwarded_For='203.0.113.7'), '10.0.0.2'),
+    (0, request(X_Real_IP='203.0.113.7'), '10.0.0.2'),
+    (1, request(X_Forwarded_For='203.0.113.7'), '203.0.113.7'),
+    (1, request(X_Forwarded_For='198.51.100.1, 203.0.113.7'), '203.0.113.7'),
+    (2, request(X_Forwarded_For='198.51.100.1, 203.0.113.7, 10.0.0.9'), '203.0.113.7'),
+    (2, request(X_Forwarded_For='203.0.113.7'), '203.0.113.7'),
+    (1, request(X_Real_IP=' 203.0.113.8 '), '203.0.113.8'),
+    (1, request(), '10.0.0.2'),
+])
+def test_client_address(monkeypatch, trusted, req, expected):
+    monkeypatch.setattr(app, 'SERVER_TRUSTED_PROXY', trusted)
+    assert app.client_address(req) == expected
+
+def test_event_carries_client_address(monkeypatch):
+    monkeypatch.setattr(app, 'SERVER_TRUSTED_PROXY', 1)
+    req = request(X_Forwarded_For='203.0.113.7')
+    req.method, req.path, req.query = 'POST', '/chat', {}
+    event = app.build_event(req, '{}')
+    assert event['requestContext']['identity']['sourceIp'] == '203.0.113.7'
@@ -0,0 +1,198 @@
+'''server.chat против настоящего PostgreSQL: отправка, чтение, 304 и long-poll'''
+import asyncio
+import json
+import time
+import uuid
+
+import pytest
+
+@pytest.fixture(scope='module')
+def notifications(loop_thread, functions):
+    from server.app import ChatNotifications
+    
+    notifications = ChatNotifications(functions['chat'])
+    
+    async def start():
+        notifications.start()
+        while not notifications.ready:
+            await asyncio.sleep(0.05)
+    
+    loop_thread.run(start())
+    yield notifications
+    loop_thread.run(notifications.stop())
+
+@pytest.fixture(scope='module')
+def async_chat(functions, pool, executor, notifications):
+    from server.chat import AsyncChat
+    
+    return AsyncChat(functions['chat'], pool, executor, notifications)
+
+@pytest.fixture
+def token(bridged_db, functions):
+    body = {'action': 'register', 'username': f'chat_{uuid.uuid4().hex[:8]}', 'password': 'secret12'}
+    result = functions['auth'].handler({'httpMethod': 'POST', 'headers': {}, 'body': json.dumps(body)}, None)
+    assert result['statusCode'] == 200
+    return json.loads(result['body'])['token']
+
+def fetch(loop_thread, async_chat, headers=None, **params):
+    event = {'httpMethod': 'GET', 'headers': headers or {},
+             'queryStringParameters': {key: str(value) for key, value in params.items()}}
+    return loop_thread.run(async_chat.handle(event))
+
+def send_event(token, message, room_id='general'):
+    return {
+        'httpMethod': 'POST',
+        'headers': {'X-Authorization': f'Bearer {token}'} if token else {},
+        'body': json.dumps({'message': message, 'roomId': room_id}),
+        'requestContext': {'identity': {'sourceIp': '127.0.0.1'}}
+    }
+
+def send(loop_thread, async_chat, token, message, room_id='general'):
+    return loop_thread.run(async_chat.handle(send_event(token, message, room_id)))
+
+def poll_event(**params):
+    return {'httpMethod': 'GET', 'headers': {},
+            'queryStringParameters': {key: str(value) for key, value in params.items()}}
+
+def delete_event(token, message_id):
+    return {'httpMethod': 'DELETE', 'headers': {'X-Authorization': f'Bearer {token}'},
+            'queryStringParameters': {'id': str(message_id)}}
+
+def wait_for_notification(chat, room_id, message_id):
+    deadline = time.monotonic() + 5
+    while chat.message_listener.latest_id(room_id) < message_id:
+        assert time.monotonic() < deadline, 'NOTIFY did not arrive'
+        time.sleep(0.05)
+
+def header(result, name):
+    return {key.lower(): value for key, value in (result.get('headers') or {}).items()}.get(name.lower())
+
+def test_sent_message_is_fetched_and_cached(loop_thread, async_chat, token):
+    text = f'hello {uuid.uuid4().hex}'
+    result = send(loop_thread, async_chat, token, text)
+    assert result['statusCode'] == 200
+    sent = json.loads(result['body'])['message']
+    assert (sent['message'], sent['roomId']) == (text, 'general')
+    
+    result = fetch(loop_thread, async_chat, room_id='general')
+    assert result['statusCode'] == 200
+    body = json.loads(result['body'])
+    assert body['messages'][-1]['id'] == sent['id']
+    assert body['messages'][-1]['message'] == text
+    
+    etag = header(result, 'ETag')
+    assert etag
+    result = fetch(loop_thread, async_chat, headers={'If-None-Match': etag}, room_id='general')
+    assert result['statusCode'] == 304
+    
+    result = fetch(loop_thread, async_chat, room_id='general', since_id=sent['id'])
+    assert result['statusCode'] == 204
+
+def test_long_poll_wakes_on_send(loop_thread, async_chat, token):
+    sent = json.loads(send(loop_thread, async_chat, token, 'before poll')['body'])['message']
+    event = {'httpMethod': 'GET', 'headers': {},
+             'queryStringParameters': {'room_id': 'general', 'since_id': str(sent['id']), 'wait': '10'}}
+    
+    async def poll_then_send():
+        poll = asyncio.ensure_future(async_chat.handle(event))
+        await asyncio.sleep(0.2)
+        assert not poll.done()
+        await async_chat.handle(send_event(token, 'wake up'))
+        return await asyncio.wait_for(poll, 5)
+    
+    started = time.monotonic()
+    result = loop_thread.run(poll_then_send())
+    assert time.monotonic() - started < 5
+    assert result['statusCode'] == 200
+    assert [m['message'] for m in json.loads(result['body'])['messages']] == ['wake up']
+
+def test_long_poll_blocks_after_newest_message_is_deleted(loop_thread, async_chat, functions, token):
+    chat = functions['chat']
+    kept = json.loads(send(loop_thread, async_chat, token, 'kept')['body'])['message']
+    newest = json.loads(send(loop_thread, async_chat, token, 'deleted soon')['body'])['message']
+    wait_for_notification(chat, 'general', newest['id'])
+    assert chat.handler(delete_event(token, newest['id']), None)['statusCode'] == 200
+    
+    polls = {
+        'server': lambda event: loop_thread.run(async_chat.handle(event)),
+        'function': lambda event: chat.handler(event, None)
+    }
+    for name, poll in polls.items():
+        started = time.monotonic()
+        result = poll(poll_event(room_id='general', since_id=kept['id'], wait=1))
+        assert result['statusCode'] == 204, name
+        assert time.monotonic() - started >= 0.9, f'{name} poll returned without waiting'
+    
+    woken = json.loads(send(loop_thread, async_chat, token, 'after delete')['body'])['message']
+    result = loop_thread.run(async_chat.handle(poll_event(room_id='general', since_id=kept['id'], wait=5)))
+    assert [m['id'] for m in json.loads(result['body'])['messages']] == [woken['id']]
+
+def insert_before_oldest_partition(bridge, token) -> tuple:
+    '''Сообщение за месяц без секции попадает в DEFAULT; между ним и секциями остаётся пустой месяц'''
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(r'''
+            INSERT INTO darkhaven_messages (room_id, user_id, message, created_at)
+            SELECT 'general', u.id, 'stuck in default', p.oldest - interval '2 months'
+            FROM darkhaven_users u, (
+                SELECT MIN(to_date(right(c.relname, 7), 'YYYY_MM'))::timestamp AS oldest
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'darkhaven_messages'::regclass
+                  AND c.relname ~ '^darkhaven_messages_\d{4}_\d{2}$'
+            ) p
+            WHERE u.token = %s
+            RETURNING id, tableoid::regclass::text, to_char(created_at, 'YYYY_MM'),
+                      to_char(created_at + interval '1 month', 'YYYY_MM')
+        ''', (token,))
+        row = cur.fetchone()
+        conn.commit()
+    return row
+
+def test_send_moves_default_rows_into_their_partition(bridge, loop_thread, async_chat, functions, token, monkeypatch):
+    chat = functions['chat']
+    sends = {
+        'server': lambda event: loop_thread.run(async_chat.handle(event)),
+        'function': lambda event: chat.handler(event, None)
+    }
+    for name, send_with in sends.items():
+        message_id, partition, month, next_month = insert_before_oldest_partition(bridge, token)
+        assert partition == 'darkhaven_messages_default'
+        
+        monkeypatch.setattr(chat, '_partitions_checked_at', float('-inf'))
+        assert send_with(send_event(token, f'partitions checked by {name}'))['statusCode'] == 200
+        
+        with bridge.connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT tableoid::regclass::text FROM darkhaven_messages WHERE id = %s', (message_id,))
+            assert cur.fetchone() == (f'darkhaven_messages_{month}',), name
+            cur.execute('SELECT COUNT(*) FROM darkhaven_messages_default')
+            assert cur.fetchone() == (0,), name
+            cur.execute('SELECT to_regclass(%s) IS NOT NULL', (f'darkhaven_messages_{next_month}',))
+            assert cur.fetchone() == (True,), f'{name}: months after the moved one were not created'
+
+def test_unknown_room_is_404_without_a_buffer(loop_thread, async_chat, functions, bridge, token):
+    chat = functions['chat']
+    polls = {
+        'server': lambda event: loop_thread.run(async_chat.handle(event)),
+        'function': lambda event: chat.handler(event, None)
+    }
+    for name, poll in polls.items():
+        room_id = f'missing_{uuid.uuid4().hex}'
+        result = poll(poll_event(room_id=room_id))
+        assert result['statusCode'] == 404, name
+        assert json.loads(result['body'])['error'] == 'Room not found'
+        assert room_id not in chat._room_buffers, name
+    
+    room_id = f'room_{uuid.uuid4().hex[:8]}'
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute('INSERT INTO darkhaven_chat_rooms (id, name) VALUES (%s, %s)', (room_id, 'Test room'))
+        conn.commit()
+    assert send(loop_thread, async_chat, token, 'first', room_id=room_id)['statusCode'] == 200
+    for name, poll in polls.items():
+        result = poll(poll_event(room_id=room_id))
+        assert result['statusCode'] == 200, name
+        assert [m['message'] for m in json.loads(result['body'])['messages']] == ['first']
+
+def test_invalid_requests(loop_thread, async_chat, token):
+    assert fetch(loop_thread, async_chat, room_id='general', since_id=1, wait='nan')['statusCode'] == 400
+    assert send(loop_thread, async_chat, None, 'anonymous')['statusCode'] == 401
+    assert send(loop_thread, async_chat, 'not-a-token', 'forged')['statusCode'] == 401
+    assert send(loop_thread, async_chat, token, 'nowhere', room_id=f'missing_{uuid.uuid4().hex}')['statusCode'] == 404
@@ -0,0 +1,142 @@
+'''server.pgbridge против настоящего PostgreSQL: то, на что полагаются обработчики psycopg2'''
+import json
+import uuid
+from decimal import Decimal
+
+import pytest
+
+@pytest.fixture
+def table(bridge):
+    name = f'bridge_test_{uuid.uuid4().hex[:8]}'
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'''
+            CREATE TABLE {name} (
+                id SERIAL PRIMARY KEY,
+                n INTEGER,
+                label TEXT UNIQUE,
+                score NUMERIC,
+                flag BOOLEAN
+            )
+        ''')
+        conn.commit()
+    yield name
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'DROP TABLE {name}')
+        conn.commit()
+
+def insert_rows(bridge, table, rows):
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.executemany(f'INSERT INTO {table} (n, label) VALUES (%s, %s)', rows)
+        conn.commit()
+        return cur.rowcount
+
+def test_rowcount_matches_psycopg2(bridge, table):
+    assert insert_rows(bridge, table, [(1, 'a'), (2, 'b'), (3, 'c')]) == 3
+    
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'UPDATE {table} SET n = n + 1 WHERE n >= %s', (2,))
+        assert cur.rowcount == 2
+        assert cur.fetchall() == []
+        
+        cur.execute(f'DELETE FROM {table} WHERE n > %s', (100,))
+        assert cur.rowcount == 0
+        
+        cur.execute(f'SELECT n FROM {table} ORDER BY n')
+        assert cur.rowcount == 3
+        assert cur.fetchone() == (1,)
+        assert cur.fetchall() == [(3,), (4,)]
+        
+        cur.execute(f'UPDATE {table} SET n = 0 WHERE label = %s RETURNING id', ('a',))
+        assert cur.rowcount == 1
+        conn.commit()
+
+def test_values_are_coerced_like_psycopg2_literals(bridge, table):
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'''
+            INSERT INTO {table} (n, label, score, flag) VALUES (%s, %s, %s, %s)
+            RETURNING n, label, score, flag
+        ''', ('7', 42, 2.5, 'true'))
+        assert cur.fetchone() == (7, '42', Decimal('2.5'), True)
+        
+        cur.execute(f'SELECT COUNT(*) FROM {table} WHERE n = ANY(%s)', (['7', 8],))
+        assert cur.fetchone() == (1,)
+        
+        cur.execute(f"SELECT label FROM {table} WHERE label LIKE %s AND '100%%' = '100%%'", ('4%',))
+        assert cur.fetchall() == [('42',)]
+        conn.commit()
+
+def test_lossy_coercion_is_a_data_error(bridge, table):
+    import psycopg2
+    
+    with bridge.connection() as conn, conn.cursor() as cur:
+        with pytest.raises(psycopg2.DataError):
+            cur.execute(f'INSERT INTO {table} (n) VALUES (%s)', (1.5,))
+        conn.rollback()
+
+def test_errors_keep_their_sqlstate(bridge, table):
+    import psycopg2
+    import psycopg2.errors
+    
+    insert_rows(bridge, table, [(1, 'dup')])
+    
+    with bridge.connection() as conn, conn.cursor() as cur:
+        with pytest.raises(psycopg2.errors.UniqueViolation):
+            cur.execute(f'INSERT INTO {table} (n, label) VALUES (%s, %s)', (2, 'dup'))
+        conn.rollback()
+        
+        with pytest.raises(psycopg2.errors.UndefinedTable):
+            cur.execute('SELECT * FROM darkhaven_no_such_table')
+        conn.rollback()
+        
+        cur.execute(f'SELECT COUNT(*) FROM {table}')
+        assert cur.fetchone() == (1,)
+
+def test_transactions_commit_and_roll_back(bridge, table):
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'INSERT INTO {table} (n, label) VALUES (%s, %s)', (1, 'kept'))
+        conn.commit()
+        cur.execute(f'INSERT INTO {table} (n, label) VALUES (%s, %s)', (2, 'undone'))
+        conn.rollback()
+    
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'INSERT INTO {table} (n, label) VALUES (%s, %s)', (3, 'never committed'))
+    
+    with bridge.connection() as conn, conn.cursor() as cur:
+        cur.execute(f'SELECT label FROM {table} ORDER BY n')
+        assert cur.fetchall() == [('kept',)]
+
+def test_handlers_run_through_the_bridge(bridged_db, functions):
+    auth, users = functions['auth'], functions['users']
+    name = f'bridge_{uuid.uuid4().hex[:8]}'
+    
+    def call(handler, body, token=None):
+        event = {
+            'httpMethod': 'POST',
+            'headers': {'X-Authorization': f'Bearer {token}'} if token else {},
+            'body': json.dumps(body),
+            'requestContext': {'identity': {'sourceIp': '127.0.0.1'}}
+        }
+        result = handler(event, None)
+        return result['statusCode'], json.loads(result['body'])
+    
+    status, registered = call(auth.handler, {'action': 'register', 'username': name, 'password': 'secret12'})
+    assert status == 200
+    status, friend = call(auth.handler, {'action': 'register', 'username': name + 'f', 'password': 'secret12'})
+    assert status == 200
+    
+    status, logged_in = call(auth.handler, {'action': 'login', 'username': name, 'password': 'secret12'})
+    assert status == 200
+    token = logged_in['token']
+    
+    status, body = call(users.handler, {'action': 'add', 'friendId': friend['user']['id']}, token)
+    assert (status, body) == (200, {'friends': [friend['user']['id']]})
+    
+    status, body = call(users.handler, {'action': 'add', 'friendId': 2 ** 31 - 1}, token)
+    assert status == 404
+    
+    status, body = call(auth.handler, {'action': 'update_profile', 'experience': 250}, token)
+    assert status == 200
+    
+    status, body = call(auth.handler, {'action': 'verify'}, token)
+    assert status == 200
+    assert body['user']['experience'] == 250
@@ -0,0 +1 @@
+'''Общий код обработчиков: ответы, разбор запросов, доступ к БД, кэши и замеры'''
@@ -0,0 +1,95 @@
+'''Пул соединений PostgreSQL, общий для всех обработчиков экземпляра'''
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from core import instrumentation
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', '30'))
+
+_pool = None
+_pool_lock = threading.Lock()
+_last_used = {}
+_connect_kwargs = {}
+_provider = None
+
+def get_dsn() -> str:
+    return os.environ.get('DATABASE_URL')
+
+def configure_connections(**kwargs):
+    '''Доп. параметры psycopg2.connect (например, cursor_factory) для соединений пула'''
+    _connect_kwargs.update(kwargs)
+
+def use_connection_provider(provider):
+    '''Заменяет пул psycopg2 внешним источником соединений (пул asyncpg в server)'''
+    global _provider
+    _provider = provider
+
+def get_pool():
+    '''Пул соединений создаётся при первом обращении и живёт между тёплыми вызовами'''
+    global _pool
+    if _pool is None or _pool.closed:
+        with _pool_lock:
+            if _pool is None or _pool.closed:
+                from psycopg2.pool import ThreadedConnectionPool
+                connect_kwargs = {**_connect_kwargs}
+                if instrumentation.ENABLED:
+                    connect_kwargs.setdefault('cursor_factory', instrumentation.timing_cursor_factory())
+                _pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, get_dsn(), **connect_kwargs)
+    return _pool
+
+def _checkout(pool):
+    import psycopg2
+    
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        last_used = _last_used.get(id(conn))
+        if not conn.closed:
+            if last_used is None or time.monotonic() - last_used < DB_POOL_PING_AFTER:
+                return conn
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+                return conn
+            except psycopg2.Error:
+                pass
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+@contextmanager
+def db_connection():
+    import psycopg2
+    
+    started = time.perf_counter() if instrumentation.ENABLED else None
+    
+    if _provider is not None:
+        with _provider() as conn:
+            if started is not None:
+                instrumentation.record_connect(started)
+            yield conn
+        return
+    
+    pool = get_pool()
+    conn = _checkout(pool)
+    if started is not None:
+        instrumentation.record_connect(started)
+    broken = False
+    
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        broken = broken or bool(conn.closed)
+        if broken:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=broken)
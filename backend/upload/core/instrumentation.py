@@ -0,0 +1,121 @@
+'''Замеры вызова обработчика: общее время, SQL, получение соединения, сериализация
+
+Включается переменными окружения: REQUEST_METRICS=1 пишет строку лога
+requestMetrics на каждый вызов, SERVER_TIMING=1 добавляет заголовок
+Server-Timing. Если обе выключены, декоратор возвращает обработчик как есть,
+а остальные хуки сводятся к проверке флага ENABLED.
+'''
+import functools
+import os
+import threading
+import time
+
+from core.timing import elapsed_ms, log_event
+
+REQUEST_METRICS = os.environ.get('REQUEST_METRICS', '0') == '1'
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+ENABLED = REQUEST_METRICS or SERVER_TIMING
+
+_state = threading.local()
+_cursor_factory = None
+
+class RequestMetrics:
+    __slots__ = ('sql_count', 'sql_ms', 'connect_ms', 'serialize_ms')
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.connect_ms = 0.0
+        self.serialize_ms = 0.0
+
+def current():
+    return getattr(_state, 'metrics', None)
+
+def record_sql(started: float):
+    metrics = current()
+    if metrics is not None:
+        metrics.sql_count += 1
+        metrics.sql_ms += (time.perf_counter() - started) * 1000
+
+def record_connect(started: float):
+    metrics = current()
+    if metrics is not None:
+        metrics.connect_ms += (time.perf_counter() - started) * 1000
+
+def record_serialize(started: float):
+    metrics = current()
+    if metrics is not None:
+        metrics.serialize_ms += (time.perf_counter() - started) * 1000
+
+def timing_cursor_factory():
+    '''Курсор psycopg2, засекающий каждый execute в метрики текущего вызова'''
+    global _cursor_factory
+    if _cursor_factory is None:
+        from psycopg2.extensions import cursor
+
+        class TimingCursor(cursor):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    record_sql(started)
+
+            def executemany(self, query, vars_list):
+                started = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    record_sql(started)
+
+        _cursor_factory = TimingCursor
+    return _cursor_factory
+
+def server_timing(metrics: RequestMetrics, total_ms: float) -> str:
+    return ', '.join((
+        f'db;dur={metrics.sql_ms:.2f};desc="{metrics.sql_count} queries"',
+        f'conn;dur={metrics.connect_ms:.2f}',
+        f'ser;dur={metrics.serialize_ms:.2f}',
+        f'total;dur={total_ms:.2f}'
+    ))
+
+def instrumented(function: str):
+    def decorate(handler):
+        if not ENABLED:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            metrics = RequestMetrics()
+            _state.metrics = metrics
+            started = time.perf_counter()
+            response = None
+
+            try:
+                response = handler(event, context)
+                return response
+            finally:
+                _state.metrics = None
+                total_ms = elapsed_ms(started)
+
+                if SERVER_TIMING and response is not None:
+                    response['headers'] = {
+                        **(response.get('headers') or {}),
+                        'Server-Timing': server_timing(metrics, total_ms),
+                        'Timing-Allow-Origin': '*'
+                    }
+
+                if REQUEST_METRICS:
+                    log_event('requestMetrics', {
+                        'function': function,
+                        'method': event.get('httpMethod'),
+                        'status': response.get('statusCode') if response is not None else None,
+                        'totalMs': total_ms,
+                        'sqlCount': metrics.sql_count,
+                        'sqlMs': round(metrics.sql_ms, 2),
+                        'connectMs': round(metrics.connect_ms, 2),
+                        'serializeMs': round(metrics.serialize_ms, 2)
+                    })
+
+        return wrapper
+    return decorate
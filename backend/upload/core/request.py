@@ -0,0 +1,25 @@
+'''Разбор входящего события облачной функции'''
+from core.codec import loads
+
+def get_header(event: dict, name: str) -> str:
+    headers = event.get('headers') or {}
+    if name in headers:
+        return headers[name]
+    lowered = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lowered:
+            return value
+    return ''
+
+def get_token(event: dict) -> str:
+    return get_header(event, 'X-Authorization').replace('Bearer ', '')
+
+def get_query_params(event: dict) -> dict:
+    return event.get('queryStringParameters') or {}
+
+def parse_body(event: dict) -> dict:
+    return loads(event.get('body') or '{}')
+
+def etag_matches(event: dict, etag: str) -> bool:
+    if_none_match = get_header(event, 'If-None-Match')
+    return bool(if_none_match) and etag in [tag.strip() for tag in if_none_match.split(',')]
@@ -1,110 +1,397 @@
-import json
 import base64
+import hashlib
+import io
+import math
 import os
+import sys
+import time
 import uuid
+import warnings
 from datetime import datetime
 
+# core лежит рядом с index.py: функция разворачивается одним каталогом (см. vendor_core.py)
+FUNCTION_DIR = os.path.dirname(os.path.abspath(__file__))
+if FUNCTION_DIR not in sys.path:
+    sys.path.insert(0, FUNCTION_DIR)
+
+from core.instrumentation import instrumented
+from core.request import parse_body
+from core.responses import error_response, preflight_headers, preflight_response, success_response
+from core.storage import (
+    BUCKET, IMMUTABLE_CACHE_CONTROL, KEY_PREFIX, cdn_url, get_s3_client, s3_client_ready, s3_setup_timings
+)
+from core.timing import elapsed_ms, log_event
+
+PRESIGN_EXPIRES = 900
+MAX_DIRECT_UPLOAD_SIZE = 100 * 1024 * 1024
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MAX_MULTIPART_UPLOAD_SIZE = 5 * 1024 * 1024 * 1024
+MULTIPART_EXTENSIONS = {'mp4', 'webm', 'mov'}
+THUMBNAIL_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+THUMBNAIL_SIZES = (64, 256, 1024)
+WEBP_QUALITY = 80
+# Кадр RGB в Pillow занимает 4 байта на пиксель: 40 Мп — около 160 МБ
+MAX_IMAGE_PIXELS = 40_000_000
+EXIF_ORIENTATION = 0x0112
+# Значения тега Orientation -> Image.Transpose, как в ImageOps.exif_transpose
+ORIENTATION_TRANSPOSE = {
+    2: 'FLIP_LEFT_RIGHT',
+    3: 'ROTATE_180',
+    4: 'FLIP_TOP_BOTTOM',
+    5: 'TRANSPOSE',
+    6: 'ROTATE_270',
+    7: 'TRANSVERSE',
+    8: 'ROTATE_90'
+}
+
+PREFLIGHT_HEADERS = preflight_headers('POST, OPTIONS', 'Content-Type')
+
+CONTENT_TYPE_MAP = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'mp4': 'video/mp4',
+    'webm': 'video/webm',
+    'mov': 'video/quicktime'
+}
+
+@instrumented('upload')
 def handler(event: dict, context) -> dict:
     '''Загрузка файлов (изображений и видео) на сервер'''
     
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return preflight_response(PREFLIGHT_HEADERS)
     
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return error_response('Method not allowed', 405)
+    
+    started = time.perf_counter()
+    client_was_warm = s3_client_ready()
+    action = None
     
     try:
-        body = json.loads(event.get('body', '{}'))
-        file_data = body.get('file')
-        file_name = body.get('fileName', 'upload')
-        file_type = body.get('fileType', 'image/png')
-        
-        if not file_data:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'No file data provided'}),
-                'isBase64Encoded': False
-            }
-        
-        file_extension = file_name.split('.')[-1] if '.' in file_name else 'png'
-        unique_id = str(uuid.uuid4())
-        new_file_name = f"{unique_id}.{file_extension}"
+        body = parse_body(event)
+        action = body.get('action', 'upload')
         
-        file_bytes = base64.b64decode(file_data.split(',')[1] if ',' in file_data else file_data)
-        
-        import boto3
-        s3 = boto3.client('s3',
-            endpoint_url='https://bucket.poehali.dev',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
-        )
-        
-        content_type_map = {
-            'png': 'image/png',
-            'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg',
-            'gif': 'image/gif',
-            'webp': 'image/webp',
-            'mp4': 'video/mp4',
-            'webm': 'video/webm',
-            'mov': 'video/quicktime'
-        }
-        
-        content_type = content_type_map.get(file_extension.lower(), 'application/octet-stream')
+        if action == 'upload':
+            return upload_inline(body)
+        elif action == 'presign':
+            return presign_upload(body)
+        elif action == 'multipart_start':
+            return start_multipart_upload(body)
+        elif action == 'multipart_complete':
+            return complete_multipart_upload(body)
+        elif action == 'multipart_abort':
+            return abort_multipart_upload(body)
+        else:
+            return error_response('Invalid action', 400)
+    
+    except Exception as e:
+        return error_response(str(e), 500)
+    
+    finally:
+        log_timing(action, client_was_warm, started)
+
+def log_timing(action, client_was_warm: bool, started: float):
+    timing = {
+        'action': action,
+        's3Client': 'warm' if client_was_warm else 'cold',
+        'totalMs': elapsed_ms(started)
+    }
+    if not client_was_warm and s3_setup_timings:
+        timing.update(s3_setup_timings)
+    log_event('uploadTiming', timing)
+
+def get_extension(file_name: str) -> str:
+    return file_name.split('.')[-1].lower() if '.' in file_name else 'png'
+
+def new_object_key(extension: str) -> str:
+    return f'{KEY_PREFIX}/{uuid.uuid4()}.{extension}'
+
+def is_own_key(key) -> bool:
+    return isinstance(key, str) and key.startswith(f'{KEY_PREFIX}/') and '..' not in key
+
+def object_exists(s3, key: str) -> bool:
+    from botocore.exceptions import ClientError
+    
+    try:
+        s3.head_object(Bucket=BUCKET, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def variant_keys(base_key: str) -> dict:
+    keys = {str(size): f'{base_key}_{size}.webp' for size in THUMBNAIL_SIZES}
+    keys['webp'] = f'{base_key}.webp'
+    return keys
+
+def encode_webp(image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return buffer.getvalue()
+
+def fit_within(image, size: int) -> tuple:
+    scale = min(size / image.width, size / image.height, 1)
+    return max(round(image.width * scale), 1), max(round(image.height * scale), 1)
+
+def open_image(file_bytes: bytes):
+    '''Читает только заголовок: размер проверяется до того, как декодируются пиксели'''
+    from PIL import Image
+    
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+    image = Image.open(io.BytesIO(file_bytes))
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        image.close()
+        raise Image.DecompressionBombError(f'{image.width}x{image.height} exceeds {MAX_IMAGE_PIXELS} pixels')
+    return image
+
+def replaced(image, result):
+    '''Память прежнего кадра освобождается сразу, а не когда до него дойдёт сборщик'''
+    if result is not image:
+        image.close()
+    return result
+
+def oriented(image, transpose):
+    from PIL import Image
+    
+    if transpose is None:
+        return image
+    return replaced(image, image.transpose(getattr(Image.Transpose, transpose)))
+
+def downscaled(image, size: int):
+    '''Новый кадр не больше size по большей стороне; исходный не меняется'''
+    from PIL import Image
+    
+    target = fit_within(image, size)
+    factor = min(image.width // target[0], image.height // target[1])
+    if factor < 2:
+        return image.resize(target, Image.LANCZOS)
+    # reduce() усредняет блоки factor x factor, и LANCZOS работает уже с малой копией
+    reduced = image.reduce(factor)
+    try:
+        return reduced.resize(target, Image.LANCZOS)
+    finally:
+        reduced.close()
+
+def render_variants(file_bytes: bytes) -> dict:
+    '''Полноразмерный WebP и миниатюры; полный кадр в памяти один
+
+    Режим меняется только у кадров, которые WebP не примет как есть, и прежний
+    кадр сразу освобождается. Миниатюры режутся из копии размером с самую
+    большую из них, и поворот по EXIF делается уже на ней; развернуть полный
+    кадр приходится лишь для полноразмерного WebP.
+    '''
+    image = open_image(file_bytes)
+    try:
+        transpose = ORIENTATION_TRANSPOSE.get(image.getexif().get(EXIF_ORIENTATION))
+        mode = 'RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB'
+        if image.mode != mode:
+            image = replaced(image, image.convert(mode))
+        thumbnail = downscaled(image, max(THUMBNAIL_SIZES))
+        image = oriented(image, transpose)
+        encoded = {'webp': encode_webp(image)}
+    finally:
+        image.close()
+    
+    image = oriented(thumbnail, transpose)
+    try:
+        for size in sorted(THUMBNAIL_SIZES, reverse=True):
+            if fit_within(image, size) != image.size:
+                image = replaced(image, downscaled(image, size))
+            encoded[str(size)] = encode_webp(image)
+    finally:
+        image.close()
+    return encoded
+
+def store_variants(s3, base_key: str, file_bytes: bytes, deduplicated: bool) -> dict:
+    try:
+        from PIL import Image
+    except ImportError:
+        return {}
+    
+    keys = variant_keys(base_key)
+    
+    if not (deduplicated and object_exists(s3, keys[str(THUMBNAIL_SIZES[0])])):
+        try:
+            rendered = render_variants(file_bytes)
+        except (OSError, Image.DecompressionBombError, Image.DecompressionBombWarning, ValueError) as e:
+            log_event('uploadVariants', {'key': base_key, 'error': str(e)})
+            return {}
         
+        for name, variant_bytes in rendered.items():
+            s3.put_object(
+                Bucket=BUCKET,
+                Key=keys[name],
+                Body=variant_bytes,
+                ContentType='image/webp',
+                CacheControl=IMMUTABLE_CACHE_CONTROL
+            )
+    
+    return {name: cdn_url(key) for name, key in keys.items()}
+
+def upload_inline(data: dict) -> dict:
+    file_data = data.get('file')
+    file_name = data.get('fileName', 'upload')
+    
+    if not file_data:
+        return error_response('No file data provided', 400)
+    
+    file_extension = get_extension(file_name)
+    file_bytes = base64.b64decode(file_data.split(',')[1] if ',' in file_data else file_data)
+    base_key = f'{KEY_PREFIX}/{hashlib.sha256(file_bytes).hexdigest()}'
+    key = f'{base_key}.{file_extension}'
+    
+    s3 = get_s3_client()
+    deduplicated = object_exists(s3, key)
+    
+    if not deduplicated:
         s3.put_object(
-            Bucket='files',
-            Key=f'dark-haven/{new_file_name}',
+            Bucket=BUCKET,
+            Key=key,
             Body=file_bytes,
-            ContentType=content_type
+            ContentType=CONTENT_TYPE_MAP.get(file_extension, 'application/octet-stream'),
+            CacheControl=IMMUTABLE_CACHE_CONTROL
         )
-        
-        cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/dark-haven/{new_file_name}"
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'success': True,
-                'url': cdn_url,
-                'fileName': new_file_name
-            }),
-            'isBase64Encoded': False
-        }
-        
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
+    
+    variants = {}
+    if file_extension in THUMBNAIL_EXTENSIONS:
+        variants = store_variants(s3, base_key, file_bytes, deduplicated)
+    
+    return success_response({
+        'success': True,
+        'url': cdn_url(key),
+        'fileName': key.split('/')[-1],
+        'deduplicated': deduplicated,
+        'variants': variants
+    })
+
+def presign_upload(data: dict) -> dict:
+    file_extension = get_extension(data.get('fileName', 'upload'))
+    file_size = data.get('fileSize')
+    
+    if file_extension not in CONTENT_TYPE_MAP:
+        return error_response('Unsupported file type', 400)
+    
+    if not isinstance(file_size, int) or file_size <= 0:
+        return error_response('fileSize required', 400)
+    
+    if file_size > MAX_DIRECT_UPLOAD_SIZE:
+        return error_response('File too large, use multipart upload', 413)
+    
+    key = new_object_key(file_extension)
+    content_type = CONTENT_TYPE_MAP[file_extension]
+    
+    upload_url = get_s3_client().generate_presigned_url(
+        'put_object',
+        Params={
+            'Bucket': BUCKET,
+            'Key': key,
+            'ContentType': content_type,
+            'ContentLength': file_size
+        },
+        ExpiresIn=PRESIGN_EXPIRES
+    )
+    
+    return success_response({
+        'success': True,
+        'uploadUrl': upload_url,
+        'method': 'PUT',
+        'headers': {'Content-Type': content_type},
+        'key': key,
+        'url': cdn_url(key),
+        'fileName': key.split('/')[-1],
+        'expiresIn': PRESIGN_EXPIRES
+    })
+
+def start_multipart_upload(data: dict) -> dict:
+    file_extension = get_extension(data.get('fileName', 'upload'))
+    file_size = data.get('fileSize')
+    
+    if file_extension not in MULTIPART_EXTENSIONS:
+        return error_response('Multipart upload is only available for video files', 400)
+    
+    if not isinstance(file_size, int) or file_size <= 0:
+        return error_response('fileSize required', 400)
+    
+    if file_size > MAX_MULTIPART_UPLOAD_SIZE:
+        return error_response('File too large', 413)
+    
+    s3 = get_s3_client()
+    key = new_object_key(file_extension)
+    
+    upload = s3.create_multipart_upload(
+        Bucket=BUCKET,
+        Key=key,
+        ContentType=CONTENT_TYPE_MAP[file_extension]
+    )
+    upload_id = upload['UploadId']
+    
+    part_count = math.ceil(file_size / MULTIPART_PART_SIZE)
+    part_urls = []
+    for part_number in range(1, part_count + 1):
+        part_urls.append({
+            'partNumber': part_number,
+            'uploadUrl': s3.generate_presigned_url(
+                'upload_part',
+                Params={
+                    'Bucket': BUCKET,
+                    'Key': key,
+                    'UploadId': upload_id,
+                    'PartNumber': part_number
+                },
+                ExpiresIn=PRESIGN_EXPIRES
+            )
+        })
+    
+    return success_response({
+        'success': True,
+        'uploadId': upload_id,
+        'key': key,
+        'partSize': MULTIPART_PART_SIZE,
+        'parts': part_urls,
+        'expiresIn': PRESIGN_EXPIRES
+    })
+
+def complete_multipart_upload(data: dict) -> dict:
+    key = data.get('key')
+    upload_id = data.get('uploadId')
+    parts = data.get('parts') or []
+    
+    if not is_own_key(key) or not upload_id or not parts:
+        return error_response('key, uploadId and parts required', 400)
+    
+    get_s3_client().complete_multipart_upload(
+        Bucket=BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            'Parts': sorted(
+                ({'PartNumber': int(part['partNumber']), 'ETag': part['etag']} for part in parts),
+                key=lambda part: part['PartNumber']
+            )
         }
+    )
+    
+    return success_response({
+        'success': True,
+        'url': cdn_url(key),
+        'fileName': key.split('/')[-1]
+    })
+
+def abort_multipart_upload(data: dict) -> dict:
+    key = data.get('key')
+    upload_id = data.get('uploadId')
+    
+    if not is_own_key(key) or not upload_id:
+        return error_response('key and uploadId required', 400)
+    
+    get_s3_client().abort_multipart_upload(Bucket=BUCKET, Key=key, UploadId=upload_id)
+    
+    return success_response({'success': True})
@@ -0,0 +1,73 @@
+'''Хеширование паролей scrypt с переходом со старых несолёных SHA-256'''
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', '16384'))
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+_executor = None
+_executor_lock = threading.Lock()
+_dummy_hash = None
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=128 * n * r * p + 1024 * 1024, dklen=KEY_BYTES
+    )
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode()
+
+def hash_password(password: str, n: int = None) -> str:
+    n = n or PASSWORD_SCRYPT_N
+    salt = secrets.token_bytes(SALT_BYTES)
+    key = _scrypt(password, salt, n, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return f'scrypt${n}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${_b64(salt)}${_b64(key)}'
+
+def verify_password(password: str, stored: str) -> tuple:
+    '''Возвращает (пароль верный, хеш нужно пересчитать с текущей стоимостью)'''
+    if not stored:
+        return False, False
+    
+    if not stored.startswith('scrypt$'):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+    
+    try:
+        _, n, r, p, salt, key = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        expected = base64.b64decode(key)
+        actual = _scrypt(password, base64.b64decode(salt), n, r, p)
+    except ValueError:
+        return False, False
+    
+    if not hmac.compare_digest(actual, expected):
+        return False, False
+    
+    return True, (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+
+def dummy_hash() -> str:
+    '''Хеш для выравнивания времени ответа, когда пользователь не найден'''
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(secrets.token_urlsafe(16))
+    return _dummy_hash
+
+def run_in_worker(func, *args):
+    '''Хеширование идёт в ограниченном пуле потоков: scrypt отпускает GIL,
+    а размер пула ограничивает CPU и память при всплеске входов'''
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+    return _executor.submit(func, *args).result()
@@ -1,59 +1,95 @@
-import json
 import os
+import sys
 from datetime import datetime
 
+# core лежит рядом с index.py: функция разворачивается одним каталогом (см. vendor_core.py)
+FUNCTION_DIR = os.path.dirname(os.path.abspath(__file__))
+if FUNCTION_DIR not in sys.path:
+    sys.path.insert(0, FUNCTION_DIR)
+
+from core.cache import TOKEN_CACHE_PEER_TTL, TOKEN_CACHE_SIZE, TokenCache
+from core.codec import loads
+from core.counters import EXPERIENCE_PER_LEVEL
+from core.db import db_connection
+from core.instrumentation import instrumented
+from core.ratelimit import RateLimiter, client_key
+from core.request import etag_matches, get_query_params, get_token, parse_body
+from core.responses import (
+    error_response, etag_headers, not_modified_response, preflight_headers,
+    preflight_response, success_response, too_many_requests_response
+)
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, OPTIONS')
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_PEER_TTL)
+search_limiter = RateLimiter('search')
+
+MAX_FRIENDS_LIMIT = 200
+MAX_SEARCH_LIMIT = 50
+TRIGRAM_MIN_LENGTH = 3
+PRESENCE_WINDOW = float(os.environ.get('PRESENCE_WINDOW', '300'))
+
+@instrumented('users')
 def handler(event: dict, context) -> dict:
     '''Управление профилями пользователей и друзьями'''
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Authorization',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return preflight_response(PREFLIGHT_HEADERS)
     
     try:
-        params = event.get('queryStringParameters') or {}
+        params = get_query_params(event)
         
         if 'id' in params:
-            return get_user_profile(params['id'])
+            return get_user_profile(params)
         elif 'search' in params:
-            return search_users(params['search'])
+            retry_after = search_limiter.check(client_key(event))
+            if retry_after is not None:
+                return too_many_requests_response(retry_after)
+            return search_users(params)
         elif method == 'POST':
             return handle_friend_action(event)
         else:
-            return get_online_users()
+            return get_online_users(event)
             
     except Exception as e:
         return error_response(str(e), 500)
 
-def get_user_profile(user_id: str) -> dict:
-    import psycopg2
-    
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
+def get_user_profile(params: dict) -> dict:
     try:
+        user_id = int(params['id'])
+        friends_limit = min(max(int(params.get('friends_limit', 50)), 1), MAX_FRIENDS_LIMIT)
+        friends_after = int(params.get('friends_after', 0))
+    except ValueError:
+        return error_response('Invalid request', 400)
+    
+    with db_connection() as conn, conn.cursor() as cur:
         cur.execute('''
-            SELECT id, username, email, avatar_url, bio, level, experience,
-                   total_messages, total_time_online, achievements, friends,
-                   online_status, created_at, last_login, last_seen
-            FROM darkhaven_users WHERE id = %s
-        ''', (user_id,))
+            SELECT u.id, u.username, u.email, u.avatar_url, u.bio,
+                   CASE WHEN p.experience > 0 THEN (u.experience + p.experience) / %s + 1 ELSE u.level END,
+                   u.experience + p.experience, u.total_messages + p.messages, u.total_time_online, u.achievements,
+                   ARRAY(
+                       SELECT friend_id FROM darkhaven_friendships
+                       WHERE user_id = u.id AND friend_id > %s
+                       ORDER BY friend_id
+                       LIMIT %s
+                   ),
+                   u.online_status, u.created_at, u.last_login, u.last_seen
+            FROM darkhaven_users u
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(SUM(messages), 0) AS messages, COALESCE(SUM(experience), 0) AS experience
+                FROM darkhaven_user_counter_deltas WHERE user_id = u.id
+            ) p
+            WHERE u.id = %s
+        ''', (EXPERIENCE_PER_LEVEL, friends_after, friends_limit + 1, user_id))
         
         user = cur.fetchone()
         
         if not user:
             return error_response('User not found', 404)
         
+        friends = user[10][:friends_limit]
+        
         return success_response({
             'user': {
                 'id': user[0],
@@ -65,33 +101,49 @@ def get_user_profile(user_id: str) -> dict:
                 'experience': user[6],
                 'totalMessages': user[7],
                 'totalTimeOnline': user[8],
-                'achievements': json.loads(user[9]) if user[9] else [],
-                'friends': json.loads(user[10]) if user[10] else [],
+                'achievements': loads(user[9]) if user[9] else [],
+                'friends': friends,
+                'friendsNextCursor': friends[-1] if len(user[10]) > friends_limit else None,
                 'onlineStatus': user[11],
-                'createdAt': user[12].isoformat(),
-                'lastLogin': user[13].isoformat() if user[13] else None,
-                'lastSeen': user[14].isoformat() if user[14] else None
+                'createdAt': user[12],
+                'lastLogin': user[13],
+                'lastSeen': user[14]
             }
         })
-        
-    finally:
-        cur.close()
-        conn.close()
 
-def search_users(query: str) -> dict:
-    import psycopg2
-    
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+def search_users(params: dict) -> dict:
+    query = params.get('search', '').strip().lower()
     
     try:
-        cur.execute('''
-            SELECT id, username, avatar_url, level, online_status
-            FROM darkhaven_users 
-            WHERE LOWER(username) LIKE LOWER(%s)
-            LIMIT 20
-        ''', (f'%{query}%',))
+        limit = min(max(int(params.get('limit', 20)), 1), MAX_SEARCH_LIMIT)
+        offset = max(int(params.get('offset', 0)), 0)
+    except ValueError:
+        return error_response('Invalid request', 400)
+    
+    if not query:
+        return success_response({'users': []})
+    
+    pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    
+    with db_connection() as conn, conn.cursor() as cur:
+        if len(query) < TRIGRAM_MIN_LENGTH:
+            cur.execute('''
+                SELECT id, username, avatar_url, level, online_status
+                FROM darkhaven_users
+                WHERE LOWER(username) LIKE %s
+                ORDER BY LOWER(username)
+                LIMIT %s OFFSET %s
+            ''', (f'{pattern}%', limit, offset))
+        else:
+            cur.execute('''
+                SELECT id, username, avatar_url, level, online_status
+                FROM darkhaven_users
+                WHERE LOWER(username) LIKE %s
+                ORDER BY LOWER(username) LIKE %s DESC,
+                         similarity(LOWER(username), %s) DESC,
+                         LOWER(username)
+                LIMIT %s OFFSET %s
+            ''', (f'%{pattern}%', f'{pattern}%', query, limit, offset))
         
         users = []
         for row in cur.fetchall():
@@ -104,26 +156,30 @@ def search_users(query: str) -> dict:
             })
         
         return success_response({'users': users})
-        
-    finally:
-        cur.close()
-        conn.close()
 
-def get_online_users() -> dict:
-    import psycopg2
-    
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    try:
+def get_online_users(event: dict) -> dict:
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT (SELECT version FROM darkhaven_versions WHERE name = 'users'),
+                   MAX(last_seen), COUNT(*)
+            FROM darkhaven_users
+            WHERE last_seen > CURRENT_TIMESTAMP - make_interval(secs => %s)
+              AND online_status IS DISTINCT FROM 'offline'
+        ''', (PRESENCE_WINDOW,))
+        users_version, last_seen, online_count = cur.fetchone()
+        etag = f'W/"{users_version}.{last_seen.timestamp() if last_seen else 0}.{online_count}"'
+        
+        if etag_matches(event, etag):
+            return not_modified_response(etag)
+        
         cur.execute('''
             SELECT id, username, avatar_url, level, online_status
             FROM darkhaven_users 
-            WHERE online_status = 'online'
+            WHERE last_seen > CURRENT_TIMESTAMP - make_interval(secs => %s)
+              AND online_status IS DISTINCT FROM 'offline'
             ORDER BY last_seen DESC
             LIMIT 50
-        ''')
+        ''', (PRESENCE_WINDOW,))
         
         users = []
         for row in cur.fetchall():
@@ -132,74 +188,66 @@ def get_online_users() -> dict:
                 'username': row[1],
                 'avatarUrl': row[2],
                 'level': row[3],
-                'onlineStatus': row[4]
+                'onlineStatus': 'away' if row[4] == 'away' else 'online'
             })
         
-        return success_response({'users': users})
-        
-    finally:
-        cur.close()
-        conn.close()
+        return success_response({'users': users}, etag_headers(etag))
+
+def get_user_id_from_token(cur, token: str):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached['id']
+    
+    cur.execute('SELECT id FROM darkhaven_users WHERE token = %s', (token,))
+    user = cur.fetchone()
+    
+    if not user:
+        return None
+    
+    token_cache.put(token, {'id': user[0]})
+    return user[0]
 
 def handle_friend_action(event: dict) -> dict:
     import psycopg2
     
-    token = event.get('headers', {}).get('X-Authorization', '').replace('Bearer ', '')
-    body = json.loads(event.get('body', '{}'))
+    token = get_token(event)
+    body = parse_body(event)
     
     action = body.get('action')
-    friend_id = body.get('friendId')
     
-    if not token or not friend_id:
-        return error_response('Invalid request', 400)
+    try:
+        friend_id = int(body.get('friendId'))
+    except (TypeError, ValueError):
+        friend_id = None
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    if not token or not friend_id or action not in ('add', 'remove'):
+        return error_response('Invalid request', 400)
     
-    try:
-        cur.execute('SELECT id, friends FROM darkhaven_users WHERE token = %s', (token,))
-        user = cur.fetchone()
+    with db_connection() as conn, conn.cursor() as cur:
+        user_id = get_user_id_from_token(cur, token)
         
-        if not user:
+        if not user_id:
             return error_response('Unauthorized', 401)
         
-        user_id = user[0]
-        friends = json.loads(user[1]) if user[1] else []
-        
-        if action == 'add' and friend_id not in friends:
-            friends.append(friend_id)
-        elif action == 'remove' and friend_id in friends:
-            friends.remove(friend_id)
-        
-        cur.execute('UPDATE darkhaven_users SET friends = %s WHERE id = %s', 
-                   (json.dumps(friends), user_id))
-        conn.commit()
+        try:
+            if action == 'add':
+                cur.execute('''
+                    INSERT INTO darkhaven_friendships (user_id, friend_id)
+                    VALUES (%s, %s)
+                    ON CONFLICT (user_id, friend_id) DO NOTHING
+                ''', (user_id, friend_id))
+            else:
+                cur.execute('DELETE FROM darkhaven_friendships WHERE user_id = %s AND friend_id = %s',
+                           (user_id, friend_id))
+            cur.execute('''
+                SELECT friend_id FROM darkhaven_friendships
+                WHERE user_id = %s
+                ORDER BY created_at, friend_id
+            ''', (user_id,))
+            friends = [row[0] for row in cur.fetchall()]
+            conn.commit()
+        except psycopg2.errors.ForeignKeyViolation:
+            conn.rollback()
+            return error_response('User not found', 404)
         
         return success_response({'friends': friends})
-        
-    finally:
-        cur.close()
-        conn.close()
-
-def success_response(data: dict) -> dict:
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps(data),
-        'isBase64Encoded': False
-    }
-
-def error_response(message: str, status_code: int) -> dict:
-    return {
-        'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({'error': message}),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
@@ -0,0 +1,70 @@
+'''Копирует backend/core в каталог каждой облачной функции
+
+Функции разворачиваются по одному каталогу (см. func2url.json), и соседний
+backend/core в сборку не попадает. Поэтому у каждой функции лежит своя копия
+пакета core рядом с index.py. Править нужно только backend/core, затем:
+
+    python vendor_core.py           # обновить копии
+    python vendor_core.py --check   # проверить, что копии совпадают (для CI)
+'''
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+CORE_DIR = os.path.join(BACKEND_DIR, 'core')
+
+def function_dirs() -> list:
+    '''Функция — каталог с index.py и requirements.txt'''
+    dirs = []
+    for name in sorted(os.listdir(BACKEND_DIR)):
+        path = os.path.join(BACKEND_DIR, name)
+        if os.path.isfile(os.path.join(path, 'index.py')) and os.path.isfile(os.path.join(path, 'requirements.txt')):
+            dirs.append(path)
+    return dirs
+
+def core_files() -> list:
+    return sorted(name for name in os.listdir(CORE_DIR) if name.endswith('.py'))
+
+def stale_files(target: str) -> list:
+    expected = core_files()
+    present = sorted(name for name in os.listdir(target) if name.endswith('.py')) if os.path.isdir(target) else []
+    stale = [name for name in present if name not in expected]
+    for name in expected:
+        copy = os.path.join(target, name)
+        if not os.path.isfile(copy) or not filecmp.cmp(os.path.join(CORE_DIR, name), copy, shallow=False):
+            stale.append(name)
+    return stale
+
+def vendor(target: str):
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    for name in core_files():
+        shutil.copy2(os.path.join(CORE_DIR, name), os.path.join(target, name))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', action='store_true', help='только проверить копии, ничего не меняя')
+    args = parser.parse_args()
+
+    outdated = []
+    for function_dir in function_dirs():
+        target = os.path.join(function_dir, 'core')
+        stale = stale_files(target)
+        if not stale:
+            continue
+        relative = os.path.relpath(target, BACKEND_DIR)
+        if args.check:
+            outdated.append(f'{relative}: {", ".join(stale)}')
+        else:
+            vendor(target)
+            print(f'updated {relative}')
+
+    if outdated:
+        sys.exit('core copies are out of date, run python vendor_core.py:\n' + '\n'.join(outdated))
+
+if __name__ == '__main__':
+    main()
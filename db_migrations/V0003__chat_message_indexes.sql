@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_darkhaven_messages_created_at ON darkhaven_messages (created_at DESC);
@@ -0,0 +1,39 @@
+CREATE TABLE IF NOT EXISTS darkhaven_versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO darkhaven_versions (name) VALUES ('messages'), ('users')
+ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION darkhaven_bump_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE darkhaven_versions SET version = version + 1 WHERE name = TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Новые сообщения видны по MAX(id), счётчик нужен только для правок и удалений
+CREATE TRIGGER darkhaven_messages_version
+    AFTER UPDATE OR DELETE ON darkhaven_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION darkhaven_bump_version('messages');
+
+-- Только поля, которые попадают в ответы чата и списка онлайн, и только если
+-- значение действительно изменилось: вход пишет online_status = 'online',
+-- а свёртка счётчиков переписывает level даже без перехода на новый уровень
+CREATE TRIGGER darkhaven_users_version
+    AFTER UPDATE OF username, avatar_url, is_admin, level, online_status ON darkhaven_users
+    FOR EACH ROW
+    WHEN (OLD.username IS DISTINCT FROM NEW.username
+          OR OLD.avatar_url IS DISTINCT FROM NEW.avatar_url
+          OR OLD.is_admin IS DISTINCT FROM NEW.is_admin
+          OR OLD.level IS DISTINCT FROM NEW.level
+          OR OLD.online_status IS DISTINCT FROM NEW.online_status)
+    EXECUTE FUNCTION darkhaven_bump_version('users');
+
+CREATE TRIGGER darkhaven_users_delete_version
+    AFTER DELETE ON darkhaven_users
+    FOR EACH STATEMENT EXECUTE FUNCTION darkhaven_bump_version('users');
+
+CREATE INDEX IF NOT EXISTS idx_darkhaven_users_online_last_seen
+    ON darkhaven_users (last_seen DESC) WHERE online_status = 'online';
@@ -0,0 +1,20 @@
+CREATE TABLE IF NOT EXISTS darkhaven_friendships (
+    user_id INTEGER NOT NULL REFERENCES darkhaven_users(id) ON DELETE CASCADE,
+    friend_id INTEGER NOT NULL REFERENCES darkhaven_users(id) ON DELETE CASCADE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, friend_id)
+);
+
+-- Перенос друзей из JSON-колонки friends. В колонке то, что присылали клиенты
+-- ("1.5", "abc", числа больше int4), а планировщик может вычислить ключ соединения
+-- раньше фильтра, поэтому приведение к int защищено CASE внутри подзапроса
+INSERT INTO darkhaven_friendships (user_id, friend_id)
+SELECT f.user_id, f.friend_id
+FROM (
+    SELECT u.id AS user_id,
+           CASE WHEN e.value ~ '^[0-9]{1,9}$' THEN e.value::int END AS friend_id
+    FROM darkhaven_users u
+    CROSS JOIN LATERAL json_array_elements_text(COALESCE(NULLIF(u.friends, ''), '[]')::json) AS e(value)
+) f
+JOIN darkhaven_users friend ON friend.id = f.friend_id
+ON CONFLICT (user_id, friend_id) DO NOTHING;
@@ -0,0 +1,9 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Подстрочный поиск и ранжирование по похожести
+CREATE INDEX IF NOT EXISTS idx_darkhaven_users_username_trgm
+    ON darkhaven_users USING gin (LOWER(username) gin_trgm_ops);
+
+-- Поиск по префиксу и сравнение LOWER(username) = LOWER(%s) при входе
+CREATE INDEX IF NOT EXISTS idx_darkhaven_users_username_lower
+    ON darkhaven_users (LOWER(username) text_pattern_ops);
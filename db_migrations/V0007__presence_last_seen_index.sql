@@ -0,0 +1,5 @@
+-- Онлайн определяется по свежести last_seen, а не по online_status
+DROP INDEX IF EXISTS idx_darkhaven_users_online_last_seen;
+
+CREATE INDEX IF NOT EXISTS idx_darkhaven_users_last_seen
+    ON darkhaven_users (last_seen DESC);
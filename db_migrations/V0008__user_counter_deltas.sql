@@ -0,0 +1,12 @@
+-- Приросты счётчиков за сообщения пишутся без блокировки строки автора
+-- и периодически сворачиваются в darkhaven_users одним UPDATE
+CREATE TABLE IF NOT EXISTS darkhaven_user_counter_deltas (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    experience INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_darkhaven_user_counter_deltas_user
+    ON darkhaven_user_counter_deltas (user_id);
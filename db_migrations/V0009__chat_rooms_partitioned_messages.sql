@@ -0,0 +1,71 @@
+-- Комнаты чата (по образцу chat_rooms из V0001)
+CREATE TABLE IF NOT EXISTS darkhaven_chat_rooms (
+    id VARCHAR(100) PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    icon VARCHAR(100),
+    description TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO darkhaven_chat_rooms (id, name) VALUES ('general', 'Общий чат')
+ON CONFLICT (id) DO NOTHING;
+
+-- Сообщения секционируются по месяцам created_at; id по-прежнему из общей последовательности
+ALTER TABLE darkhaven_messages RENAME TO darkhaven_messages_legacy;
+ALTER TABLE darkhaven_messages_legacy RENAME CONSTRAINT darkhaven_messages_pkey TO darkhaven_messages_legacy_pkey;
+DROP TRIGGER IF EXISTS darkhaven_messages_version ON darkhaven_messages_legacy;
+
+CREATE TABLE darkhaven_messages (
+    id INTEGER NOT NULL DEFAULT nextval('darkhaven_messages_id_seq'),
+    room_id VARCHAR(100) NOT NULL DEFAULT 'general' REFERENCES darkhaven_chat_rooms (id),
+    user_id INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    edited BOOLEAN DEFAULT FALSE,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE darkhaven_messages_id_seq OWNED BY darkhaven_messages.id;
+
+-- Страховка на случай, если месячная секция не была создана заранее
+CREATE TABLE darkhaven_messages_default PARTITION OF darkhaven_messages DEFAULT;
+
+CREATE OR REPLACE FUNCTION darkhaven_create_message_partitions(months_ahead INTEGER, since TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', since);
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= date_trunc('month', CURRENT_TIMESTAMP) + make_interval(months => months_ahead) LOOP
+        partition_name := 'darkhaven_messages_' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF darkhaven_messages FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_start + interval '1 month'
+            );
+            created := created + 1;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT darkhaven_create_message_partitions(3, COALESCE(
+    (SELECT MIN(created_at) FROM darkhaven_messages_legacy), LOCALTIMESTAMP
+));
+
+-- История комнаты читается диапазоном по (room_id, id) в каждой секции
+CREATE INDEX IF NOT EXISTS idx_darkhaven_messages_room_id
+    ON darkhaven_messages (room_id, id);
+
+INSERT INTO darkhaven_messages (id, room_id, user_id, message, created_at, edited)
+SELECT id, 'general', user_id, message, COALESCE(created_at, CURRENT_TIMESTAMP), edited
+FROM darkhaven_messages_legacy;
+
+DROP TABLE darkhaven_messages_legacy;
+
+CREATE TRIGGER darkhaven_messages_version
+    AFTER UPDATE OR DELETE ON darkhaven_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION darkhaven_bump_version('messages');
@@ -0,0 +1,16 @@
+-- Манифест архивных сегментов истории чата (сами сегменты лежат в S3)
+CREATE TABLE IF NOT EXISTS darkhaven_message_segments (
+    id SERIAL PRIMARY KEY,
+    room_id VARCHAR(100) NOT NULL REFERENCES darkhaven_chat_rooms (id),
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    first_at TIMESTAMP NOT NULL,
+    last_at TIMESTAMP NOT NULL,
+    message_count INTEGER NOT NULL,
+    object_key TEXT NOT NULL UNIQUE,
+    codec VARCHAR(10) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_darkhaven_message_segments_room_last_id
+    ON darkhaven_message_segments (room_id, last_id DESC);
@@ -0,0 +1,6 @@
+-- Общие бакеты ограничителя частоты; данные вспомогательные, WAL для них не нужен
+CREATE UNLOGGED TABLE IF NOT EXISTS darkhaven_rate_limits (
+    bucket_key VARCHAR(200) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
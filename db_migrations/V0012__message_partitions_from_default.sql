@@ -0,0 +1,43 @@
+-- Месяц без своей секции копит строки в DEFAULT, и тогда CREATE TABLE ... PARTITION OF
+-- для него падает ("updated partition constraint for default partition would be violated"),
+-- обрывая весь цикл. Теперь такие строки переносятся в новую секцию, а проход начинается
+-- с самого раннего месяца, застрявшего в DEFAULT
+CREATE OR REPLACE FUNCTION darkhaven_create_message_partitions(months_ahead INTEGER, since TIMESTAMP DEFAULT LOCALTIMESTAMP)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', LEAST(since, (SELECT MIN(created_at) FROM darkhaven_messages_default)));
+    month_end TIMESTAMP;
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= date_trunc('month', LOCALTIMESTAMP) + make_interval(months => months_ahead) LOOP
+        partition_name := 'darkhaven_messages_' || to_char(month_start, 'YYYY_MM');
+        month_end := month_start + interval '1 month';
+        IF to_regclass(partition_name) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM darkhaven_messages_default WHERE created_at >= month_start AND created_at < month_end) THEN
+                EXECUTE format('CREATE TABLE %I (LIKE darkhaven_messages INCLUDING DEFAULTS)', partition_name);
+                -- Строки переносятся мимо родителя: триггер версии сообщений не срабатывает, id не меняются
+                EXECUTE format(
+                    'WITH moved AS (DELETE FROM darkhaven_messages_default WHERE created_at >= %L AND created_at < %L RETURNING *)
+                     INSERT INTO %I SELECT * FROM moved',
+                    month_start, month_end, partition_name
+                );
+                EXECUTE format(
+                    'ALTER TABLE darkhaven_messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_end
+                );
+            ELSE
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF darkhaven_messages FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_end
+                );
+            END IF;
+            created := created + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT darkhaven_create_message_partitions(3);
@@ -25,10 +25,17 @@ export interface User {
 
 export interface ChatMessage {
   id: number;
+  userId: number;
   message: string;
   timestamp: string;
   edited: boolean;
-  user: User;
+  user?: User;
+}
+
+export interface ChatMessagesPage {
+  roomId?: string;
+  messages: ChatMessage[];
+  users: Record<number, User>;
 }
 
 export const api = {
@@ -89,19 +96,26 @@ export const api = {
     return response.json();
   },
 
-  async getMessages(limit = 50) {
-    const response = await fetch(`${API_URLS.chat}?limit=${limit}`);
+  async getMessages(limit = 50, cursor: { sinceId?: number; beforeId?: number; wait?: number; roomId?: string } = {}): Promise<ChatMessagesPage> {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (cursor.roomId !== undefined) params.set('room_id', cursor.roomId);
+    if (cursor.sinceId !== undefined) params.set('since_id', String(cursor.sinceId));
+    if (cursor.beforeId !== undefined) params.set('before_id', String(cursor.beforeId));
+    if (cursor.wait !== undefined) params.set('wait', String(cursor.wait));
+    
+    const response = await fetch(`${API_URLS.chat}?${params}`);
+    if (response.status === 204) return { messages: [], users: {} };
     return response.json();
   },
 
-  async sendMessage(token: string, message: string) {
+  async sendMessage(token: string, message: string, roomId?: string) {
     const response = await fetch(API_URLS.chat, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
         'Authorization': `Bearer ${token}`
       },
-      body: JSON.stringify({ message })
+      body: JSON.stringify({ message, roomId })
     });
     
     if (!response.ok) {
@@ -128,8 +142,9 @@ export const api = {
     return response.json();
   },
 
-  async searchUsers(query: string) {
-    const response = await fetch(`${API_URLS.users}?search=${encodeURIComponent(query)}`);
+  async searchUsers(query: string, limit = 20, offset = 0) {
+    const params = new URLSearchParams({ search: query, limit: String(limit), offset: String(offset) });
+    const response = await fetch(`${API_URLS.users}?${params}`);
     return response.json();
   },
 